@@ -1,34 +1,46 @@
 import logging
-import logging.handlers
-import multiprocessing
 import os
 import sys
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../../")
 
 from bs4 import BeautifulSoup
 import argparse
-import asyncio
-from utils.crawler_util import CrawlerUtil, Info, Parser, CrawlerConfig
+from utils.crawler_util import CrawlerUtil, Info, Parser, CrawlerConfig, Selector, has_class, parse_html, stream_async
+from utils.pagination_util import Paginator
 from utils.database_utils import init_database, DataBaseType
-from utils.http_utils import AsyncRequestUtil
+from utils.http_utils import AsyncRequestUtil, RetryPolicy
+from utils.rate_limit_util import SharedRateLimiter
+from utils.cache_util import ResponseCache
+from utils.archive_util import PageArchive
+from utils.content_index_util import ContentIndex
+from utils.frontier_util import PersistentFrontier
 from utils.logger_util import MultiProcesses_Logger_Util
 from table import Underarmour
-from multiprocessing import Pool
-from functools import partial
-from utils.helper import split_chunk
+from crawler_categories import discover_categories
 import json
 import math
+from datetime import datetime
+from urllib.parse import urlsplit
+from functools import partial
 
 site_name = 'underarmour'
+natural_key = 'prod_id'
 main_page_url = "https://www.underarmour.tw"
+# items of a full listing page.
+page_size = 40
+
+items_selector = Selector(f'//*[{has_class("list-item")}]')
+price_selector = Selector(f'.//*[{has_class("good-price")}]//span')
+a_selector = Selector(f'.//*[{has_class("good-txt")}]')
 
-def crawl_page(logger: logging.Logger, document: bytes, url: str, category_url: str):
+def crawl_page(logger: logging.Logger, document: bytes, url: str, category_url: str, parser: Parser=Parser.LXML):
     results = []
     if not document:
         return results, None
     
-    document: BeautifulSoup = BeautifulSoup(document, Parser.LXML.value)
+    # the listing is a fragment without a charset, which html5lib would guess as windows-1252.
+    document: BeautifulSoup = BeautifulSoup(document, parser.value, from_encoding='utf-8')
 
     try:
         items_blocks = document.select('.list-item')
@@ -44,65 +56,98 @@ def crawl_page(logger: logging.Logger, document: bytes, url: str, category_url:
             results.append(item)
     except Exception as error:
         logger.error("Error occurred %s %s", url, category_url)
-        return results, Info(next_info=None, retry_info=url)
+        # the same param fetch_page takes, so the retry log can be replayed.
+        return results, Info(next_info=None, retry_info={"url": url, "category_url": category_url})
     logger.info("Crawled %s", url)
     return results, None
 
-def request_page(queue: multiprocessing.Queue, inputs_chunk: List[str]) -> Tuple[List[Dict[str, Any]], List[Info]]:
-    sub_logger = logging.getLogger(site_name)
-    sub_logger.setLevel(logging.INFO)
-    queue_handler = logging.handlers.QueueHandler(queue)
+def crawl_page_lxml(logger: logging.Logger, document: bytes, url: str, category_url: str):
+    # crawl_page on a native lxml tree, both give the same records.
+    results = []
+    if not document:
+        return results, None
 
-    if len(sub_logger.handlers) == 0 or not isinstance(sub_logger.handlers[0], logging.handlers.QueueHandler):
-        sub_logger.addHandler(queue_handler)
+    document = parse_html(document)
 
-    data_of_urls = []
-    info_of_urls = []
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    session = AsyncRequestUtil(main_page_url=main_page_url, loop=loop, logger=sub_logger)
     try:
-        coroutines = [session.get(param['url'], with_return=param) for param in inputs_chunk]
-        coroutines_iterator = asyncio.as_completed(coroutines)
-        for coroutine in coroutines_iterator:
-            dom, param = loop.run_until_complete(coroutine)
-            url = param['url']
-            category_url = param['category_url']
-            data_per_url, info = crawl_page(sub_logger, dom, url, category_url)
-            if data_per_url:
-                data_of_urls.extend(data_per_url)
-            if info:
-                info_of_urls.extend(info)
+        for item_block in items_selector(document):
+            item = {}
+            price = price_selector.first(item_block).text_content()
+            item['price'] = int(price.replace("NT$", ""))
+            a_block = a_selector.first(item_block)
+            item['url'] = main_page_url + a_block.attrib['href']
+            item['title'] = a_block.text_content()
+            item['prod_id'] = item['url'].replace("https://www.underarmour.tw/p", '').split("-")[0]
+            results.append(item)
     except Exception as error:
-        sub_logger.error(error)
-    finally:
-        asyncio.run(session.close())
-        return data_of_urls, info_of_urls
-
-def start_crawler(crawler_config: CrawlerConfig):
-    logger_queue: multiprocessing.Queue = crawler_config.logger_queue
-    crawler_util =crawler_config.crawler_util
-    main_logger = logging.getLogger('main')
+        logger.error("Error occurred %s %s", url, category_url)
+        return results, Info(next_info=None, retry_info={"url": url, "category_url": category_url})
+    logger.info("Crawled %s", url)
+    return results, None
 
-    pool = Pool(processes=crawler_config.process_num)
+def parse_page(
+        logger: logging.Logger, 
+        document: Optional[bytes], 
+        param: Dict[str, str], 
+        parser: Parser=Parser.LXML_HTML
+    ) -> Tuple[List[Dict[str, Any]], Optional[Info]]:
+    if parser == Parser.LXML_HTML:
+        return crawl_page_lxml(logger, document, param['url'], param['category_url'])
+    return crawl_page(logger, document, param['url'], param['category_url'], parser)
 
-    total_urls = []
+async def fetch_page(session: AsyncRequestUtil, param: Dict[str, str]) -> Optional[bytes]:
+    return await session.get(param['url'])
 
-    with open('categories.json', 'r') as openfile: 
-        categories = json.load(openfile) 
+def get_listing_param(category: Dict[str, Any], page: int) -> Dict[str, str]:
+    url = f'{main_page_url}/sys/navigation/loading?nav={category["nav"]}&pageNumber={page}'
+    return {"url": url, "category_url": category['url']}
 
+def get_listings(categories: Iterable[Dict[str, Any]]) -> Iterator[Tuple[Dict[str, Any], Optional[int]]]:
     for category in categories:
-        nav = category['nav']
-        category_url = category['url']
-        total_page = math.ceil(category['total'] / 40) # 40 items in one page.
-        for page in range(1, total_page + 1):
-            url = f'{main_page_url}/sys/navigation/loading?nav={nav}&pageNumber={page}'
-            total_urls.append({"url": url, "category_url": category_url})
-
-    inputs_chunks = split_chunk(total_urls, crawler_config.chunk_size)
-    
+        # the total may be stale, it only sizes the window of the first pages.
+        total_page = math.ceil(category['total'] / page_size) if category.get('total') else None
+        yield category, total_page
+
+def start_crawler(
+        crawler_config: CrawlerConfig, 
+        replay_retries: bool=False, 
+        categories_file: Optional[str]=None, 
+        discovery_concurrency: int=10, 
+        page_window: int=2, 
+        parser: Parser=Parser.LXML_HTML, 
+        reparse: bool=False
+    ):
+    crawler_util =crawler_config.crawler_util
+    main_logger = logging.getLogger('main')
+
+    fetch_pool = None
+    if reparse:
+        # nothing is fetched, every core parses the archived pages.
+        parse_pool = crawler_util.create_parse_pool(crawler_config, site_name)
+    else:
+        fetch_pool, parse_pool = crawler_util.create_pools(crawler_config, site_name, {'main_page_url': main_page_url})
+
+    if categories_file:
+        with open(categories_file, 'r') as openfile: 
+            categories = json.load(openfile) 
+    else:
+        # listing pages of a category are crawled while the other categories are still discovered.
+        categories = stream_async(
+            lambda session: discover_categories(session, main_logger, main_page_url, discovery_concurrency), 
+            main_logger, 
+            {'rate_limiter': crawler_config.rate_limiter, 'retry_policy': crawler_config.retry_policy}
+        )
+    # pages of a category are requested until its first empty or short one.
+    paginator = Paginator(get_listing_param, window=page_window, page_size=page_size)
+    parse_fn = partial(parse_page, parser=parser)
+
     try:
-        _ = crawler_util.imap(pool, partial(request_page, logger_queue), inputs_chunks)
+        if reparse:
+            _ = crawler_util.reparse(parse_pool, parse_fn, crawler_config.page_archive)
+        elif replay_retries:
+            _ = crawler_util.replay_retries(fetch_pool, parse_pool, fetch_page, parse_fn)
+        else:
+            _ = crawler_util.crawl(fetch_pool, parse_pool, fetch_page, parse_fn, paginator.paginate(get_listings(categories)), paginator)
     except Exception as error:
         main_logger.error(error)
     finally:
@@ -110,17 +155,79 @@ def start_crawler(crawler_config: CrawlerConfig):
         main_logger.info('Total saved %s into database.', crawler_util.total_count)
 
         logger_util.close()
-        crawler_util.close(pool=pool)
+        crawler_util.close(*[pool for pool in (fetch_pool, parse_pool) if pool])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--processes", help="crawl with n processes", type=int, default=5)
-    parser.add_argument("-c", "--chunk_size", help="size of tasks inside one process.", type=int, default=20)
+    parser.add_argument("-p", "--processes", help="fetch with n processes", type=int, default=5)
+    parser.add_argument("-c", "--fetch_concurrency", help="in-flight requests kept inside one fetch process.", type=int, default=20)
+    parser.add_argument("--parse_workers", help="parse with n processes.", type=int, default=os.cpu_count())
+    parser.add_argument("-r", "--rate", help="max requests per second to the site across all processes, 0 means unlimited.", type=float, default=0)
+    parser.add_argument("--max_in_flight", help="max concurrent requests to the site across all processes, 0 means unlimited.", type=int, default=0)
+    parser.add_argument("-a", "--adaptive", help="adapt in-flight requests of every process to the site, up to --fetch_concurrency.", action="store_true")
+    parser.add_argument("-b", "--batch_size", help="save into database every n records.", type=int, default=500)
+    parser.add_argument("--cache", help="keep responses on disk and revalidate them with the site on the next run.", action="store_true")
+    parser.add_argument("--cache_ttl", help="seconds a cached response is used without asking the site, 0 means always revalidate.", type=float, default=0)
+    parser.add_argument("-i", "--incremental", help="keep one database across runs and update stored products instead of duplicating them.", action="store_true")
+    parser.add_argument("--resume", help="continue the last run from where it stopped.", action="store_true")
+    parser.add_argument("--replay_retries", help="crawl the params of the retry log again instead, and drop the ones that succeed from it.", action="store_true")
+    parser.add_argument("--retry_concurrency", help="in-flight requests kept inside one fetch process with --replay_retries.", type=int, default=5)
+    parser.add_argument("--retry_delay", help="base seconds of the backoff between attempts with --replay_retries.", type=float, default=5.0)
+    parser.add_argument("--discovery_concurrency", help="category pages fetched at the same time.", type=int, default=10)
+    parser.add_argument("--categories_file", help="crawl the categories saved by crawler_categories.py instead of discovering them.", type=str, default=None)
+    parser.add_argument("--page_window", help="listing pages of one category in flight at the same time.", type=int, default=2)
+    parser.add_argument("--parquet", help="save into a compressed Parquet file instead of SQLite.", action="store_true")
+    parser.add_argument("--capture", help="keep the raw body of every fetched page in the page archive.", action="store_true")
+    parser.add_argument("--reparse", help="parse the pages of the page archive again instead of crawling, without any request.", action="store_true")
+    parser.add_argument("--parser", help="lxml.html parses with precompiled selectors, the others with BeautifulSoup.", choices=[item.value for item in Parser], default=Parser.LXML_HTML.value)
+    parser.add_argument("--skip_unchanged", help="do not parse pages the site reports unchanged, requires --incremental.", action="store_true")
+    parser.add_argument("--skip_same_content", help="do not parse or store pages whose body hashes the same as in an earlier run, requires --incremental.", action="store_true")
     args = parser.parse_args()
+    if args.reparse and (args.resume or args.replay_retries):
+        parser.error("--reparse can't be combined with --resume or --replay_retries.")
+    if args.parquet and args.incremental:
+        parser.error("--incremental updates stored rows, which a Parquet file can't do.")
+    if args.parquet and args.resume:
+        parser.error("a Parquet file is only readable once its run finishes, so a --parquet run can't be resumed.")
+    if args.skip_unchanged and not args.incremental:
+        parser.error("--skip_unchanged requires --incremental, the storage that keeps the records of earlier runs.")
+    if args.skip_same_content and not args.incremental:
+        parser.error("--skip_same_content requires --incremental, the storage that keeps the records of earlier runs.")
 
     logger_util = MultiProcesses_Logger_Util(site_name)
-    database = init_database(database_type=DataBaseType.DATABASE, site_name=site_name, fields=Underarmour)
-    crawler_util = CrawlerUtil(database=database)
-
-    crawler_config = CrawlerConfig(crawler_util=crawler_util, logger_queue=logger_util.queue, process_num=args.processes, chunk_size=args.chunk_size)    
-    start_crawler(crawler_config)
\ No newline at end of file
+    persistent_frontier = PersistentFrontier(os.getcwd() + '/data/' + site_name + '_frontier.sqlite3')
+    if args.replay_retries or args.reparse or args.parquet:
+        # the log itself keeps the progress of a replay, and a reparse requests nothing, so the frontier of the last run stays resumable.
+        # buffered Parquet rows are lost with a killed run, so their params can't be marked done either.
+        persistent_frontier = None
+    if args.incremental:
+        # products are only known after their listing page is parsed, so every listing is still fetched.
+        file_name = persistent_frontier.start(site_name, args.resume) if persistent_frontier else site_name
+        database = init_database(database_type=DataBaseType.DATABASE, site_name=site_name, file_name=file_name, fields=Underarmour, natural_key=natural_key)
+    else:
+        file_name = site_name + "_{:%Y-%m-%d_%H-%M-%S}".format(datetime.now())
+        if persistent_frontier:
+            file_name = persistent_frontier.start(file_name, args.resume)
+        database_type = DataBaseType.PARQUET if args.parquet else DataBaseType.DATABASE
+        database = init_database(database_type=database_type, site_name=site_name, file_name=file_name, fields=Underarmour)
+    crawler_util = CrawlerUtil(database=database, batch_size=args.batch_size, persistent_frontier=persistent_frontier)
+
+    rate_limiter = None
+    if args.rate or args.max_in_flight:
+        rate_limiter = SharedRateLimiter({urlsplit(main_page_url).hostname: (args.rate, args.max_in_flight)})
+    response_cache = None
+    if args.cache:
+        response_cache = ResponseCache(os.getcwd() + '/data/' + site_name + '_http_cache.sqlite3', ttl=args.cache_ttl)
+    page_archive = None
+    if args.capture or args.reparse:
+        page_archive = PageArchive(os.getcwd() + '/data/' + site_name + '_archive')
+    content_index = None
+    if args.skip_same_content and not (args.replay_retries or args.reparse):
+        content_index = ContentIndex(os.getcwd() + '/data/' + site_name + '_content_index.sqlite3')
+    fetch_concurrency = args.fetch_concurrency
+    retry_policy = None
+    if args.replay_retries:
+        fetch_concurrency = args.retry_concurrency
+        retry_policy = RetryPolicy(base_delay=args.retry_delay)
+    crawler_config = CrawlerConfig(crawler_util=crawler_util, logger_queue=logger_util.queue, process_num=args.processes, fetch_concurrency=fetch_concurrency, parse_workers=args.parse_workers, rate_limiter=rate_limiter, adaptive_concurrency=args.adaptive, response_cache=response_cache, skip_unchanged=args.skip_unchanged, retry_policy=retry_policy, page_archive=page_archive, content_index=content_index)
+    start_crawler(crawler_config, args.replay_retries, args.categories_file, args.discovery_concurrency, args.page_window, Parser(args.parser), args.reparse)
\ No newline at end of file
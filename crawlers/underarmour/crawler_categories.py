@@ -1,6 +1,7 @@
 import logging
 import os
 import sys
+from typing import Any, AsyncIterator, Dict
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../../")
 
@@ -57,23 +58,42 @@ def crawl_page(logger: logging.Logger, document: bytes):
         return []
     return results
 
-def request_categories(logger: logging.Logger, url: str):
+async def discover_categories(session: AsyncRequestUtil, logger: logging.Logger, url: str, concurrency: int=10) -> AsyncIterator[Dict[str, Any]]:
+    # fetches every category page concurrently, and yields each category as soon as its total is known.
+    document = await session.get(url)
+    category_urls = crawl_page(logger, document) if document else []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def request_category(category_url: str):
+        async with slots:
+            document = await session.get(category_url)
+        info = crawl_category_info(logger, document, category_url) if document else []
+        if not info:
+            return None
+        total, nav = info
+        return {'url': category_url, 'total': total, 'nav': nav}
+
+    for task in asyncio.as_completed([request_category(category_url) for category_url in category_urls]):
+        category = await task
+        if category:
+            yield category
+
+def request_categories(logger: logging.Logger, url: str, concurrency: int=10):
     categories = []
-    loop = asyncio.get_event_loop()
+    loop = asyncio.new_event_loop()
     session = AsyncRequestUtil(loop=loop, logger=logger)
 
-    try:
-        document = loop.run_until_complete(session.get(url))
-        data_of_urls = crawl_page(logger, document)
-        for url in data_of_urls:
-            document = loop.run_until_complete(session.get(url))
-            total, nav = crawl_category_info(logger, document, url)
-            category = {'url': url, 'total': total, 'nav': nav}
+    async def collect():
+        async for category in discover_categories(session, logger, url, concurrency):
             categories.append(category)
+
+    try:
+        loop.run_until_complete(collect())
     except Exception as error:
         logger.error(error)
     finally:
-        asyncio.run(session.close())
+        loop.run_until_complete(session.close())
+        loop.close()
         return categories
 
 def start_crawler(crawler_config: CrawlerConfig):
@@ -89,6 +109,7 @@ def start_crawler(crawler_config: CrawlerConfig):
         crawler_util.save()
         main_logger.info('Total saved %s categories.', crawler_util.total_count)
         logger_util.close()
+        crawler_util.close()
 
 if __name__ == "__main__":
     logger_util = MultiProcesses_Logger_Util(site_name)
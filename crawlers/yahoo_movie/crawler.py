@@ -1,39 +1,74 @@
 import logging
-import logging.handlers
-import multiprocessing
 import os
 import sys
-import traceback
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../../")
 
 from bs4 import BeautifulSoup
 import argparse
-import asyncio
-from utils.crawler_util import CrawlerUtil, Info, Parser, CrawlerConfig
+from utils.crawler_util import CrawlerUtil, Info, Parser, CrawlerConfig, Region, Selector, get_strainer, has_class, parse_html
 from utils.database_utils import init_database, DataBaseType
-from utils.http_utils import AsyncRequestUtil
+from utils.http_utils import AsyncRequestUtil, RetryPolicy
+from utils.rate_limit_util import SharedRateLimiter
+from utils.cache_util import ResponseCache
+from utils.archive_util import PageArchive
+from utils.content_index_util import ContentIndex
+from utils.frontier_util import PersistentFrontier
+from utils.dedup_util import SeenUrls
 from utils.logger_util import MultiProcesses_Logger_Util
 from table import YahooMovie
-from multiprocessing import Pool
 from datetime import datetime
 import re
+from urllib.parse import urlsplit, urljoin
 from functools import partial
-from utils.helper import split_chunk
 
 site_name = 'yahoo_movie'
+natural_key = 'movie_id'
 main_page_url = "https://movies.yahoo.com.tw/index.html"
 
-def crawl_page(logger: logging.Logger, document: bytes):
+# the parts of a movie page crawl_page reads, a page is only parsed up to the last of them.
+regions = [
+    Region('meta', attrs={'property': 'og:url'}), 
+    Region('meta', attrs={'property': 'og:image'}), 
+    Region(class_name='movie_intro_info_l'), 
+    Region(class_name='movie_intro_info_r'), 
+    Region(id='story'), 
+    Region(class_name='score_num'), 
+    Region(class_name='starbox2'), 
+]
+
+movie_links_selector = Selector('//a[contains(@href, "movieinfo_main.html/id=")]/@href')
+url_selector = Selector('//meta[@property="og:url"]/@content')
+movie_info_selector = Selector(f'//*[{has_class("movie_intro_info_r")}]')
+name_ch_selector = Selector('.//h1')
+name_en_selector = Selector('.//h3')
+genres_selector = Selector(f'.//*[{has_class("level_name")}]')
+all_info_selector = Selector('.//span')
+# the div right after a span, what findNext('div') finds.
+next_div_selector = Selector('(descendant::div | following::div)[1]')
+big_image_selector = Selector(f'//*[{has_class("movie_intro_info_l")}]//*[{has_class("btn_zoomin")}]/@href')
+image_selector = Selector('//meta[@property="og:image"]/@content')
+content_selector = Selector('//*[@id="story"]')
+yahoo_score_selector = Selector(f'//*[{has_class("score_num")} and {has_class("count")}]')
+vote_count_selector = Selector(f'//*[{has_class("starbox2")}]//span')
+
+def get_movie_links(document: BeautifulSoup, url: str) -> List[str]:
+    # every movie this page links to, the next level of a --follow_links crawl.
+    return [urljoin(url, a_block['href']).split('#')[0] for a_block in document.select('a[href*="movieinfo_main.html/id="]')]
+
+def crawl_page(logger: logging.Logger, document: bytes, url: str='', follow_links: bool=False, parser: Parser=Parser.LXML):
     result = {}
     if not document:
         return [], None
 
-    document = BeautifulSoup(document, Parser.LXML.value)
+    # links can be anywhere in the page, and html5lib can't parse a part of it.
+    parse_only = get_strainer(regions) if not follow_links and parser != Parser.HTML5LIB else None
+    document = BeautifulSoup(document, parser.value, parse_only=parse_only)
+    next_info = get_movie_links(document, url) if follow_links else None
     
     url_block = document.select_one('meta[property="og:url"]')
     if not url_block or url_block and  '/id=' not in url_block['content']: 
-        return [], None
+        return [], Info(next_info=next_info, retry_info=None) if next_info else None
 
     movie_info_block = document.select_one('.movie_intro_info_r')
     name_ch_block = movie_info_block.select_one('h1') if movie_info_block else ''
@@ -95,9 +130,84 @@ def crawl_page(logger: logging.Logger, document: bytes):
         result['vote_count'] = int(vote_count[0]) if vote_count else 0
     except Exception as error:
         logger.error("Error occurred %s ", result['url'])
-        return [], Info(next_info=None, retry_info=result['url'])
+        return [], Info(next_info=next_info, retry_info=result['url'])
+    logger.info("Crawled %s", result['url'])
+    return [result], Info(next_info=next_info, retry_info=None) if next_info else None
+
+def get_movie_links_lxml(document, url: str) -> List[str]:
+    return [urljoin(url, href).split('#')[0] for href in movie_links_selector(document)]
+
+def get_text(block) -> str:
+    return block.text_content() if block is not None else ''
+
+def crawl_page_lxml(logger: logging.Logger, document: bytes, url: str='', follow_links: bool=False):
+    # crawl_page on a native lxml tree, both give the same records.
+    result = {}
+    if not document:
+        return [], None
+
+    # links can be anywhere in the page.
+    document = parse_html(document, None if follow_links else regions)
+    next_info = get_movie_links_lxml(document, url) if follow_links else None
+
+    page_url = url_selector.first(document)
+    if not page_url or '/id=' not in page_url:
+        return [], Info(next_info=next_info, retry_info=None) if next_info else None
+
+    movie_info_block = movie_info_selector.first(document)
+    name_ch_block = name_ch_selector.first(movie_info_block) if movie_info_block is not None else None
+    name_en_block = name_en_selector.first(movie_info_block) if movie_info_block is not None else None
+    genres_blocks = genres_selector(movie_info_block) if movie_info_block is not None else []
+    all_info = all_info_selector(movie_info_block) if movie_info_block is not None else []
+    big_image_url = big_image_selector.first(document)
+    image_url = image_selector.first(document)
+    content_block = content_selector.first(document)
+    yahoo_score_block = yahoo_score_selector.first(document)
+    vote_count_block = vote_count_selector.first(document)
+
+    try:
+        result['url'] = page_url
+        result['movie_id'] = int(result['url'].split('=')[-1])
+        result['name_ch'] = get_text(name_ch_block)
+        result['name_en'] = get_text(name_en_block)
+        result['genres'] = '|'.join(get_text(genres_block).strip() for genres_block in genres_blocks)
+
+        release_date = None #date
+        company = ''
+        imdb_score = 0.0
+        directors = ''
+        actors = ''
+        for info in all_info:
+            info_text = info.text_content()
+            if '上映日期' in info_text:
+                release_date = info_text.split('：')[-1]
+            if '發行公司' in info_text:
+                company = info_text.split('：')[-1]
+            if 'IMDb分數' in info_text:
+                imdb_score = info_text.split('：')[-1]
+            if '導演' in info_text:
+                directors = get_text(next_div_selector.first(info)).strip().replace(' ', '').replace('\n', '').replace('、', '|')
+            if '演員' in info_text:
+                actors = get_text(next_div_selector.first(info)).strip().replace(' ', '').replace('\n', '').replace('、', '|')
+        result['release_date'] = datetime.strptime(release_date, "%Y-%m-%d").date() if release_date and '未定' not in release_date else None
+        result['company'] = company
+        result['imdb_score'] = float(imdb_score)
+        result['directors'] = directors
+        result['actors'] = actors
+
+        result['img_url'] = big_image_url if big_image_url is not None else image_url or ''
+
+        result['content'] = get_text(content_block).strip().replace('\r', '').replace('\n', '')
+        # 滿分 5
+        result['yahoo_score'] = float(get_text(yahoo_score_block)) if yahoo_score_block is not None else 0.0
+
+        vote_count = re.findall(r'\d+', get_text(vote_count_block))
+        result['vote_count'] = int(vote_count[0]) if vote_count else 0
+    except Exception as error:
+        logger.error("Error occurred %s ", result['url'])
+        return [], Info(next_info=next_info, retry_info=result['url'])
     logger.info("Crawled %s", result['url'])
-    return [result], None
+    return [result], Info(next_info=next_info, retry_info=None) if next_info else None
 
 def retry_function(status_code: int, response: Union[Dict[str, Any], bytes, None], **kwargs) -> bool:
     result = False
@@ -107,50 +217,68 @@ def retry_function(status_code: int, response: Union[Dict[str, Any], bytes, None
         result = True
     return result
 
-def request_page(queue: multiprocessing.Queue, inputs_chunk: List[str]) -> Tuple[List[Dict[str, Any]], List[Info]]:
-    sub_logger = logging.getLogger(site_name)
-    sub_logger.setLevel(logging.INFO)
-    queue_handler = logging.handlers.QueueHandler(queue)
-
-    if len(sub_logger.handlers) == 0 or not isinstance(sub_logger.handlers[0], logging.handlers.QueueHandler):
-        sub_logger.addHandler(queue_handler)
+def parse_page(
+        logger: logging.Logger, 
+        document: Optional[bytes], 
+        url: str, 
+        follow_links: bool=False, 
+        parser: Parser=Parser.LXML_HTML
+    ) -> Tuple[List[Dict[str, Any]], Optional[Info]]:
+    if parser == Parser.LXML_HTML:
+        return crawl_page_lxml(logger, document, url, follow_links)
+    return crawl_page(logger, document, url, follow_links, parser)
 
-    data_of_urls = []
-    info_of_urls = []
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    session = AsyncRequestUtil(main_page_url=main_page_url, loop=loop, logger=sub_logger)
-    try:
-        coroutines = [session.get(url, allow_redirects=False, retry_function=retry_function) for url in inputs_chunk]
-        coroutines_iterator = asyncio.as_completed(coroutines)
-        for coroutine in coroutines_iterator:
-            dom = loop.run_until_complete(coroutine)
-            data_per_url, info = crawl_page(sub_logger, dom)
-            if data_per_url:
-                data_of_urls.extend(data_per_url)
-            if info:
-                info_of_urls.extend(info)
-    except Exception as error:
-        sub_logger.error(error)
-    finally:
-        asyncio.run(session.close())
-        return data_of_urls, info_of_urls
+async def fetch_page(session: AsyncRequestUtil, url: str) -> Optional[bytes]:
+    return await session.get(url, allow_redirects=False, retry_function=retry_function)
 
-def start_crawler(crawler_config: CrawlerConfig, upper_limit):
-    logger_queue: multiprocessing.Queue = crawler_config.logger_queue
+def start_crawler(
+        crawler_config: CrawlerConfig, 
+        upper_limit, 
+        known_ids: Optional[Set[int]]=None, 
+        recheck_known: bool=False, 
+        replay_retries: bool=False, 
+        max_depth: Optional[int]=None, 
+        parser: Parser=Parser.LXML_HTML, 
+        reparse: bool=False
+    ):
     crawler_util: CrawlerUtil =crawler_config.crawler_util
 
     main_logger = logging.getLogger('main')
 
     # must init all processes inside main function.
-    pool = Pool(processes=crawler_config.process_num)
+    fetch_pool = None
+    if reparse:
+        # nothing is fetched, every core parses the archived pages.
+        parse_pool = crawler_util.create_parse_pool(crawler_config, site_name)
+    else:
+        fetch_pool, parse_pool = crawler_util.create_pools(crawler_config, site_name, {'main_page_url': main_page_url})
 
-    inputs_chunks = split_chunk(
-        [f"https://movies.yahoo.com.tw/movieinfo_main.html/id={i}" for i in range(1, upper_limit)], 
-        crawler_config.chunk_size
-    )
+    known_ids = known_ids or set()
+    new_ids = [i for i in range(1, upper_limit) if i not in known_ids]
+    old_ids = [i for i in range(1, upper_limit) if i in known_ids]
+    main_logger.info('%s new movies, %s known movies %s.', len(new_ids), len(old_ids), 'rechecked last' if recheck_known else 'skipped')
+    # new movies first, movies stored by an earlier run only when they should be refreshed.
+    ids = new_ids + old_ids if recheck_known else new_ids
+    urls = [f"https://movies.yahoo.com.tw/movieinfo_main.html/id={i}" for i in ids]
+    parse_fn = partial(parse_page, parser=parser)
     try:
-        _ = crawler_util.imap(pool, partial(request_page, logger_queue), inputs_chunks)
+        if reparse:
+            _ = crawler_util.reparse(parse_pool, parse_fn, crawler_config.page_archive)
+        elif replay_retries:
+            _ = crawler_util.replay_retries(fetch_pool, parse_pool, fetch_page, parse_fn)
+        elif max_depth is not None:
+            # discovers movies from the main page instead of guessing ids up to upper_limit.
+            seen_urls = SeenUrls(os.getcwd() + '/data/' + site_name + '_seen_urls.sqlite3')
+            seen_urls.clear()
+            try:
+                _ = crawler_util.crawl_links(
+                    fetch_pool, parse_pool, fetch_page, partial(parse_page, follow_links=True, parser=parser), [main_page_url], seen_urls, 
+                    max_depth=max_depth, allowed_domains=[urlsplit(main_page_url).hostname]
+                )
+            finally:
+                seen_urls.close()
+        else:
+            _ = crawler_util.crawl(fetch_pool, parse_pool, fetch_page, parse_fn, urls)
     except Exception as error:
         main_logger.error(error)
     finally:
@@ -158,18 +286,83 @@ def start_crawler(crawler_config: CrawlerConfig, upper_limit):
         main_logger.info('Total saved %s into database.', crawler_util.total_count)
 
         logger_util.close()
-        crawler_util.close(pool=pool)
+        crawler_util.close(*[pool for pool in (fetch_pool, parse_pool) if pool])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--processes", help="crawl with n processes", type=int, default=5)
-    parser.add_argument("-c", "--chunk_size", help="size of tasks inside one process.", type=int, default=20)
+    parser.add_argument("-p", "--processes", help="fetch with n processes", type=int, default=5)
+    parser.add_argument("-c", "--fetch_concurrency", help="in-flight requests kept inside one fetch process.", type=int, default=20)
+    parser.add_argument("--parse_workers", help="parse with n processes.", type=int, default=os.cpu_count())
+    parser.add_argument("-r", "--rate", help="max requests per second to the site across all processes, 0 means unlimited.", type=float, default=0)
+    parser.add_argument("--max_in_flight", help="max concurrent requests to the site across all processes, 0 means unlimited.", type=int, default=0)
+    parser.add_argument("-a", "--adaptive", help="adapt in-flight requests of every process to the site, up to --fetch_concurrency.", action="store_true")
+    parser.add_argument("-b", "--batch_size", help="save into database every n records.", type=int, default=500)
+    parser.add_argument("--cache", help="keep responses on disk and revalidate them with the site on the next run.", action="store_true")
+    parser.add_argument("--cache_ttl", help="seconds a cached response is used without asking the site, 0 means always revalidate.", type=float, default=0)
+    parser.add_argument("-i", "--incremental", help="keep one database across runs, skip stored movies and update changed ones.", action="store_true")
+    parser.add_argument("--recheck_known", help="with --incremental, crawl stored movies again after the new ones.", action="store_true")
+    parser.add_argument("--resume", help="continue the last run from where it stopped.", action="store_true")
+    parser.add_argument("--replay_retries", help="crawl the params of the retry log again instead, and drop the ones that succeed from it.", action="store_true")
+    parser.add_argument("--retry_concurrency", help="in-flight requests kept inside one fetch process with --replay_retries.", type=int, default=5)
+    parser.add_argument("--retry_delay", help="base seconds of the backoff between attempts with --replay_retries.", type=float, default=5.0)
+    parser.add_argument("--follow_links", help="crawl breadth first from the main page through the movie links of every page.", action="store_true")
+    parser.add_argument("--max_depth", help="links followed away from the main page with --follow_links.", type=int, default=3)
+    parser.add_argument("--parquet", help="save into a compressed Parquet file instead of SQLite.", action="store_true")
+    parser.add_argument("--capture", help="keep the raw body of every fetched page in the page archive.", action="store_true")
+    parser.add_argument("--reparse", help="parse the pages of the page archive again instead of crawling, without any request.", action="store_true")
+    parser.add_argument("--parser", help="lxml.html parses with precompiled selectors, the others with BeautifulSoup.", choices=[item.value for item in Parser], default=Parser.LXML_HTML.value)
+    parser.add_argument("--skip_unchanged", help="do not parse pages the site reports unchanged, requires --incremental.", action="store_true")
+    parser.add_argument("--skip_same_content", help="do not parse or store pages whose body hashes the same as in an earlier run, requires --incremental.", action="store_true")
     parser.add_argument("-u", "--upper_limit", help="upper limit of this website.", type=int, default=300) # 12900
     args = parser.parse_args()
+    if args.reparse and (args.resume or args.replay_retries):
+        parser.error("--reparse can't be combined with --resume or --replay_retries.")
+    if args.parquet and args.incremental:
+        parser.error("--incremental updates stored rows, which a Parquet file can't do.")
+    if args.parquet and args.resume:
+        parser.error("a Parquet file is only readable once its run finishes, so a --parquet run can't be resumed.")
+    if args.skip_unchanged and not args.incremental:
+        parser.error("--skip_unchanged requires --incremental, the storage that keeps the records of earlier runs.")
+    if args.skip_same_content and not args.incremental:
+        parser.error("--skip_same_content requires --incremental, the storage that keeps the records of earlier runs.")
+    if args.follow_links and args.resume:
+        parser.error("a --follow_links crawl can't be resumed.")
 
     logger_util = MultiProcesses_Logger_Util(site_name)
-    database = init_database(database_type=DataBaseType.DATABASE, site_name=site_name, fields=YahooMovie)
-    crawler_util = CrawlerUtil(database=database)
-    crawler_config = CrawlerConfig(crawler_util=crawler_util, logger_queue=logger_util.queue, process_num=args.processes, chunk_size=args.chunk_size)
+    persistent_frontier = PersistentFrontier(os.getcwd() + '/data/' + site_name + '_frontier.sqlite3')
+    if args.replay_retries or args.reparse or args.parquet:
+        # the log itself keeps the progress of a replay, and a reparse requests nothing, so the frontier of the last run stays resumable.
+        # buffered Parquet rows are lost with a killed run, so their params can't be marked done either.
+        persistent_frontier = None
+    known_ids = set()
+    if args.incremental:
+        file_name = persistent_frontier.start(site_name, args.resume) if persistent_frontier else site_name
+        database = init_database(database_type=DataBaseType.DATABASE, site_name=site_name, file_name=file_name, fields=YahooMovie, natural_key=natural_key)
+        known_ids = database.load_keys()
+    else:
+        file_name = site_name + "_{:%Y-%m-%d_%H-%M-%S}".format(datetime.now())
+        if persistent_frontier:
+            file_name = persistent_frontier.start(file_name, args.resume)
+        database_type = DataBaseType.PARQUET if args.parquet else DataBaseType.DATABASE
+        database = init_database(database_type=database_type, site_name=site_name, file_name=file_name, fields=YahooMovie)
+    crawler_util = CrawlerUtil(database=database, batch_size=args.batch_size, persistent_frontier=persistent_frontier)
+    rate_limiter = None
+    if args.rate or args.max_in_flight:
+        rate_limiter = SharedRateLimiter({urlsplit(main_page_url).hostname: (args.rate, args.max_in_flight)})
+    response_cache = None
+    if args.cache:
+        response_cache = ResponseCache(os.getcwd() + '/data/' + site_name + '_http_cache.sqlite3', ttl=args.cache_ttl)
+    page_archive = None
+    if args.capture or args.reparse:
+        page_archive = PageArchive(os.getcwd() + '/data/' + site_name + '_archive')
+    content_index = None
+    if args.skip_same_content and not (args.replay_retries or args.reparse):
+        content_index = ContentIndex(os.getcwd() + '/data/' + site_name + '_content_index.sqlite3')
+    fetch_concurrency = args.fetch_concurrency
+    retry_policy = None
+    if args.replay_retries:
+        fetch_concurrency = args.retry_concurrency
+        retry_policy = RetryPolicy(base_delay=args.retry_delay)
+    crawler_config = CrawlerConfig(crawler_util=crawler_util, logger_queue=logger_util.queue, process_num=args.processes, fetch_concurrency=fetch_concurrency, parse_workers=args.parse_workers, rate_limiter=rate_limiter, adaptive_concurrency=args.adaptive, response_cache=response_cache, skip_unchanged=args.skip_unchanged, retry_policy=retry_policy, page_archive=page_archive, content_index=content_index)
     
-    start_crawler(crawler_config, args.upper_limit)
\ No newline at end of file
+    start_crawler(crawler_config, args.upper_limit, known_ids, args.recheck_known, args.replay_retries, args.max_depth if args.follow_links else None, Parser(args.parser), args.reparse)
\ No newline at end of file
@@ -0,0 +1,29 @@
+import os
+import sys
+from typing import Any, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.database_utils import BackgroundWriter, JsonLinesUtil
+
+def run_writer(database: JsonLinesUtil) -> Tuple[int, List[Any], List[Tuple[List[Any], str]]]:
+    saved = []
+    failed = []
+    writer = BackgroundWriter(
+        database, on_saved=saved.extend, on_failed=lambda done, error: failed.append((done, error))
+    )
+    writer.put([{'param': 1}], [1])
+    return writer.close(), saved, failed
+
+def test_saved_batch(tmp_path):
+    database = JsonLinesUtil(str(tmp_path / 'records'))
+    total_count, saved, failed = run_writer(database)
+    database.close()
+    assert (total_count, saved, failed) == (1, [1], [])
+
+def test_failed_batch_is_not_saved(tmp_path):
+    database = JsonLinesUtil(str(tmp_path / 'records'))
+    database.file.close()
+    total_count, saved, failed = run_writer(database)
+    assert total_count == 0 and saved == []
+    assert [done for done, _ in failed] == [[1]]
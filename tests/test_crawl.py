@@ -0,0 +1,77 @@
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.content_index_util import ContentIndex
+from utils.crawler_util import CrawlerUtil, CrawlerConfig, Info
+from utils.database_utils import JsonLinesUtil
+from utils.retry_log_util import RetryLog
+
+async def fetch_page(session: Any, param: int) -> bytes:
+    return str(param).encode()
+
+def parse_page(logger: logging.Logger, document: Optional[bytes], param: int) -> Tuple[List[Dict[str, Any]], Optional[Info]]:
+    return [{'param': param, 'document': document.decode()}], None
+
+def run_crawl(
+        tmp_path, 
+        inputs: List[int], 
+        process_num: int, 
+        timeout: float=30, 
+        database: Optional[JsonLinesUtil]=None, 
+        content_index: Optional[ContentIndex]=None
+    ) -> List[Dict[str, Any]]:
+    database = database or JsonLinesUtil(str(tmp_path / 'records'))
+    crawler_util = CrawlerUtil(database=database, retry_log=RetryLog(str(tmp_path / 'retry_info.jsonl')))
+    crawler_config = CrawlerConfig(
+        crawler_util=crawler_util, logger_queue=multiprocessing.Queue(), process_num=process_num,
+        fetch_concurrency=2, parse_workers=2, content_index=content_index
+    )
+    fetch_pool, parse_pool = crawler_util.create_pools(crawler_config, 'test')
+    crawl = threading.Thread(
+        target=crawler_util.crawl, args=(fetch_pool, parse_pool, fetch_page, parse_page, inputs), daemon=True
+    )
+    crawl.start()
+    crawl.join(timeout)
+    if crawl.is_alive():
+        fetch_pool.terminate()
+        parse_pool.terminate()
+        pytest.fail('crawl() still waits for fetch workers after {}s'.format(timeout))
+    crawler_util.close(fetch_pool, parse_pool)
+    with open(str(tmp_path / 'records.jsonl'), 'r', encoding='utf-8') as records_file:
+        return [json.loads(line) for line in records_file]
+
+@pytest.mark.parametrize('trial', range(10))
+def test_crawl_empty_inputs(tmp_path, trial: int):
+    # a process that is done at once picks up another fetch_worker task, while another one gets none.
+    assert run_crawl(tmp_path, [], process_num=8) == []
+
+def test_crawl_fewer_inputs_than_processes(tmp_path):
+    records = run_crawl(tmp_path, [1, 2, 3], process_num=8)
+    assert sorted(records, key=lambda record: record['param']) == [
+        {'param': 1, 'document': '1'}, {'param': 2, 'document': '2'}, {'param': 3, 'document': '3'}
+    ]
+
+def test_failed_save_keeps_bodies_out_of_content_index(tmp_path):
+    content_index = ContentIndex(str(tmp_path / 'content_index.sqlite3'))
+    database = JsonLinesUtil(str(tmp_path / 'records'))
+    database.file.close()
+    assert run_crawl(tmp_path, [1, 2], process_num=2, database=database, content_index=content_index) == []
+    with open(str(tmp_path / 'retry_info.jsonl'), 'r', encoding='utf-8') as retry_file:
+        assert sorted(json.loads(line) for line in retry_file) == [1, 2]
+    content_index = ContentIndex(content_index.file_path)
+    assert content_index.lookup(1) is None and content_index.lookup(2) is None
+
+def test_saved_bodies_in_content_index(tmp_path):
+    content_index = ContentIndex(str(tmp_path / 'content_index.sqlite3'))
+    assert len(run_crawl(tmp_path, [1, 2], process_num=2, content_index=content_index)) == 2
+    content_index = ContentIndex(content_index.file_path)
+    assert content_index.lookup(1) == (ContentIndex.get_hash(b'1'), 1)
@@ -0,0 +1,79 @@
+import importlib.util
+import logging
+import os
+import sys
+from types import ModuleType
+
+import pytest
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+sys.path.append(root_path)
+
+from utils.crawler_util import Parser
+
+logger = logging.getLogger('test')
+bs4_parsers = [Parser.LXML, Parser.HTMLPARSER, Parser.HTML5LIB]
+
+def load_crawler(site_name: str) -> ModuleType:
+    # every crawler imports its own table module from its directory.
+    crawler_path = os.path.join(root_path, 'crawlers', site_name)
+    sys.modules.pop('table', None)
+    sys.path.insert(0, crawler_path)
+    try:
+        spec = importlib.util.spec_from_file_location(site_name + '_crawler', os.path.join(crawler_path, 'crawler.py'))
+        crawler = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(crawler)
+    finally:
+        sys.path.remove(crawler_path)
+        sys.modules.pop('table', None)
+    return crawler
+
+def read_fixture(file_name: str) -> bytes:
+    with open(os.path.join(fixtures_path, file_name), 'rb') as fixture_file:
+        return fixture_file.read()
+
+@pytest.fixture(scope='module')
+def yahoo_movie() -> ModuleType:
+    return load_crawler('yahoo_movie')
+
+@pytest.fixture(scope='module')
+def underarmour() -> ModuleType:
+    return load_crawler('underarmour')
+
+@pytest.mark.parametrize('parser', bs4_parsers, ids=lambda parser: parser.value)
+@pytest.mark.parametrize('file_name', ['yahoo_movie.html', 'yahoo_movie_sparse.html'])
+def test_yahoo_movie_parity(yahoo_movie: ModuleType, file_name: str, parser: Parser):
+    document = read_fixture(file_name)
+    url = 'https://movies.yahoo.com.tw/movieinfo_main.html/id=11622'
+    records, info = yahoo_movie.crawl_page(logger, document, url, parser=parser)
+    assert records and info is None
+    assert yahoo_movie.crawl_page_lxml(logger, document, url) == (records, info)
+
+@pytest.mark.parametrize('parser', [Parser.LXML, Parser.HTMLPARSER], ids=lambda parser: parser.value)
+def test_yahoo_movie_follow_links_parity(yahoo_movie: ModuleType, parser: Parser):
+    document = read_fixture('yahoo_movie.html')
+    url = 'https://movies.yahoo.com.tw/movieinfo_main.html/id=11622'
+    records, info = yahoo_movie.crawl_page(logger, document, url, follow_links=True, parser=parser)
+    assert info.next_info
+    assert yahoo_movie.crawl_page_lxml(logger, document, url, follow_links=True) == (records, info)
+
+def test_yahoo_movie_expected_record(yahoo_movie: ModuleType):
+    records, _ = yahoo_movie.crawl_page_lxml(logger, read_fixture('yahoo_movie.html'))
+    record = records[0]
+    assert record['movie_id'] == 11622
+    assert record['genres'] == '動作|冒險|科幻'
+    assert record['directors'] == '強華茲'
+    assert record['actors'] == '湯姆霍蘭德|千黛亞|班奈狄克康柏拜區'
+    assert record['img_url'].endswith('spiderman-1000x1429.jpg')
+    assert record['yahoo_score'] == 4.4
+    assert record['vote_count'] == 25698
+
+@pytest.mark.parametrize('parser', bs4_parsers, ids=lambda parser: parser.value)
+def test_underarmour_parity(underarmour: ModuleType, parser: Parser):
+    document = read_fixture('underarmour_listing.html')
+    url = 'https://www.underarmour.tw/sys/navigation/loading?nav=a&pageNumber=1'
+    category_url = 'https://www.underarmour.tw/cmens-a'
+    records, info = underarmour.crawl_page(logger, document, url, category_url, parser)
+    assert len(records) == 3 and info is None
+    assert underarmour.crawl_page_lxml(logger, document, url, category_url) == (records, info)
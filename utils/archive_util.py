@@ -0,0 +1,126 @@
+import contextvars
+import json
+import mmap
+import os
+import sqlite3
+import time
+import zlib
+from collections import namedtuple
+from typing import Any, Iterator, Optional
+
+from .helper import param_key
+
+ArchiveEntry = namedtuple('ArchiveEntry', ['param', 'url', 'status', 'offset', 'length', 'fetched_at'])
+
+# the param a fetch worker is fetching, set for each of its requests so captured pages can be parsed again.
+archive_param: contextvars.ContextVar = contextvars.ContextVar('archive_param', default=None)
+
+class PageArchive:
+    # raw response bodies appended as gzip members to one file (zcat reads it whole), and a sqlite index
+    # of their offsets. Created in the main process, every process opens its own file and connection.
+    def __init__(self, file_path: str, compress_level: int=6):
+        # PageArchive('data/yahoo_movie_archive') keeps data/yahoo_movie_archive.gz and its .sqlite3 index.
+        self.file_path = file_path
+        self.data_path = file_path + '.gz'
+        self.index_path = file_path + '.sqlite3'
+        self.compress_level = compress_level
+        self.pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self._file_descriptor: Optional[int] = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    def __getstate__(self):
+        # sent to parse workers, which open their own handles.
+        state = dict(self.__dict__)
+        state.update(pid=None, _connection=None, _file_descriptor=None, _mmap=None)
+        return state
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self.pid != os.getpid():
+            self._reset()
+            os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+            # entries() is read by the task feeder thread of a pool.
+            self._connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, url TEXT, param TEXT, status INTEGER, '
+                'offset INTEGER, length INTEGER, size INTEGER, etag TEXT, last_modified TEXT, content_type TEXT, fetched_at REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS pages_key ON pages (key, id)')
+        return self._connection
+
+    def _reset(self):
+        # handles inherited through fork belong to the parent process.
+        self.pid = os.getpid()
+        self._connection = None
+        self._file_descriptor = None
+        self._mmap = None
+
+    def append(
+            self,
+            url: str,
+            status: int,
+            body: bytes,
+            param: Any=None,
+            etag: Optional[str]=None,
+            last_modified: Optional[str]=None,
+            content_type: Optional[str]=None
+        ):
+        connection = self.connection
+        if self._file_descriptor is None:
+            self._file_descriptor = os.open(self.data_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+        member = compressor.compress(body) + compressor.flush()
+        # one write with O_APPEND, so members of several processes never interleave.
+        written = os.write(self._file_descriptor, member)
+        if written != len(member):
+            raise OSError('Short write into {}'.format(self.data_path))
+        offset = os.lseek(self._file_descriptor, 0, os.SEEK_CUR) - written
+        connection.execute(
+            'INSERT INTO pages (key, url, param, status, offset, length, size, etag, last_modified, content_type, fetched_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                param_key(param if param is not None else url), url, param_key(param) if param is not None else None,
+                status, offset, written, len(body), etag, last_modified, content_type, time.time()
+            )
+        )
+
+    def entries(self) -> Iterator[ArchiveEntry]:
+        # the latest page of every param, in the order they were first archived.
+        rows = self.connection.execute(
+            'SELECT param, url, status, offset, length, fetched_at FROM pages '
+            'WHERE id IN (SELECT MAX(id) FROM pages GROUP BY key) ORDER BY id'
+        )
+        for param, url, status, offset, length, fetched_at in rows:
+            yield ArchiveEntry(json.loads(param) if param is not None else url, url, status, offset, length, fetched_at)
+
+    def count(self) -> int:
+        # pages entries() yields.
+        return self.connection.execute('SELECT COUNT(DISTINCT key) FROM pages').fetchone()[0]
+
+    def read(self, entry: ArchiveEntry) -> bytes:
+        end = entry.offset + entry.length
+        if self.pid != os.getpid():
+            self._reset()
+        if self._mmap is None or len(self._mmap) < end:
+            # mapped again only when the archive has grown past the last mapping.
+            if self._mmap is not None:
+                self._mmap.close()
+            with open(self.data_path, 'rb') as archive_file:
+                self._mmap = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return zlib.decompress(self._mmap[entry.offset:end], 31)
+
+    def close(self):
+        if self.pid != os.getpid():
+            self._reset()
+            return
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file_descriptor is not None:
+            os.close(self._file_descriptor)
+        if self._connection is not None:
+            self._connection.close()
+        self._reset()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import namedtuple
+from typing import Any, Dict, Optional, Union
+
+CacheEntry = namedtuple('CacheEntry', ['status', 'body', 'etag', 'last_modified', 'stored_at'])
+
+class CachedDocument(bytes):
+    # a response body served by the cache, either fresh within the ttl or revalidated by a 304.
+    not_modified = True
+
+class ResponseCache:
+    # created in the main process, every process opens its own connection to the same sqlite file.
+    def __init__(self, file_path: str, ttl: float=0.0, max_bytes: int=1024 * 1024 * 1024, compress_level: int=6):
+        self.file_path = file_path
+        # seconds a response is served without any request, 0 means always revalidate.
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self.unchecked_bytes = 0
+        self.pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._connection = sqlite3.connect(self.file_path, timeout=30, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, url TEXT, status INTEGER, body BLOB, etag TEXT, last_modified TEXT, '
+                'stored_at REAL, accessed_at REAL, size INTEGER)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        return self._connection
+
+    @classmethod
+    def get_key(
+            cls,
+            method: str,
+            url: str,
+            query_strings: Optional[Dict[str, str]]=None,
+            body: Union[Dict[str, Any], bytes, None]=None,
+            json_body: Optional[Dict[str, Any]]=None
+        ) -> str:
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        key = json.dumps([method, url, query_strings, body, json_body], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return bool(self.ttl) and time.time() - entry.stored_at < self.ttl
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        row = self.connection.execute(
+            'SELECT status, body, etag, last_modified, stored_at FROM responses WHERE key = ?', (key, )
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        status, body, etag, last_modified, stored_at = row
+        return CacheEntry(status, zlib.decompress(body), etag, last_modified, stored_at)
+
+    def put(self, key: str, url: str, status: int, body: bytes, etag: Optional[str], last_modified: Optional[str]):
+        now = time.time()
+        compressed_body = zlib.compress(body, self.compress_level)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses (key, url, status, body, etag, last_modified, stored_at, accessed_at, size) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, url, status, compressed_body, etag, last_modified, now, now, len(compressed_body))
+        )
+        self.unchecked_bytes += len(compressed_body)
+        # summing the table is not free, so only check the size after every few megabytes.
+        if self.unchecked_bytes >= min(self.max_bytes // 20, 8 * 1024 * 1024):
+            self.unchecked_bytes = 0
+            self.evict()
+
+    def touch(self, key: str):
+        # a 304 makes the stored response fresh again.
+        self.connection.execute('UPDATE responses SET stored_at = ? WHERE key = ?', (time.time(), key))
+
+    def evict(self):
+        # least recently used responses go first.
+        total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        overflow = total_bytes - self.max_bytes
+        if overflow <= 0:
+            return
+        keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            keys.append((key, ))
+            overflow -= size
+            if overflow <= 0:
+                break
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', keys)
+
+    def close(self):
+        if self._connection is not None and self.pid == os.getpid():
+            self._connection.close()
+        self._connection = None
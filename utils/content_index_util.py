@@ -0,0 +1,93 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .helper import param_key
+
+class ContentIndex:
+    # the hash and the record count of the last stored body of every param, kept across runs,
+    # so a body that hasn't changed is neither parsed nor written again.
+    def __init__(self, file_path: str, commit_interval: int=500):
+        self.file_path = file_path
+        # touches and updates are committed after this many of them, and when the index is closed.
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        # the main process writes from the collector and the background writer.
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(pid=None, _connection=None, lock=None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None or self.pid != os.getpid():
+            # fetch workers only read it, with their own connections.
+            self.pid = os.getpid()
+            os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.file_path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS contents ('
+                'key TEXT PRIMARY KEY, hash BLOB, count INTEGER, changed_at REAL, last_seen REAL) WITHOUT ROWID'
+            )
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def get_hash(body: bytes) -> bytes:
+        return hashlib.blake2b(body, digest_size=16).digest()
+
+    def lookup(self, param: Any) -> Optional[Tuple[bytes, int]]:
+        # the hash and the record count stored for this param.
+        with self.lock:
+            return self.connection.execute('SELECT hash, count FROM contents WHERE key = ?', (param_key(param), )).fetchone()
+
+    def is_unchanged(self, param: Any, content_hash: bytes) -> bool:
+        stored = self.lookup(param)
+        return stored is not None and stored[0] == content_hash
+
+    def touch(self, param: Any):
+        # the body was seen again unchanged.
+        with self.lock:
+            self.connection.execute('UPDATE contents SET last_seen = ? WHERE key = ?', (time.time(), param_key(param)))
+            self._commit_if_due(1)
+
+    def update(self, contents: List[Tuple[Any, bytes, int]]):
+        # (param, hash, count) of bodies whose records are saved.
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                'INSERT INTO contents (key, hash, count, changed_at, last_seen) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                'changed_at = CASE WHEN hash = excluded.hash THEN changed_at ELSE excluded.changed_at END, '
+                'hash = excluded.hash, count = excluded.count, last_seen = excluded.last_seen',
+                ((param_key(param), content_hash, count, now, now) for param, content_hash, count in contents)
+            )
+            self._commit_if_due(len(contents))
+
+    def _commit_if_due(self, changes: int):
+        self.uncommitted += changes
+        if self.uncommitted >= self.commit_interval:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        if self._connection is None or self.pid != os.getpid():
+            self._connection = None
+            return
+        with self.lock:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
@@ -1,73 +1,794 @@
+import asyncio
 from collections import namedtuple
 from enum import Enum
-import json
 import logging
+import logging.handlers
 import multiprocessing
+from multiprocessing.util import Finalize
+from functools import partial
 import os
+import queue
+import threading
+import time
 
-from .database_utils import DatabaseUtil, JsonUtil, CsvUtil
-from typing import Optional, Union, List, Dict, Any, Tuple, Iterator, Callable
+from .http_utils import AsyncRequestUtil, ConcurrencyController, RetryPolicy
+from .rate_limit_util import SharedRateLimiter
+from .cache_util import ResponseCache
+from .archive_util import PageArchive, ArchiveEntry, archive_param
+from .content_index_util import ContentIndex
+from .frontier_util import PersistentFrontier
+from .retry_log_util import RetryLog
+from .dedup_util import SeenUrls
+from .pagination_util import Paginator
+from .helper import param_key
+from urllib.parse import urlsplit
+from .database_utils import DatabaseUtil, JsonUtil, JsonLinesUtil, CsvUtil, ParquetUtil, BackgroundWriter
+from typing import Optional, Union, List, Dict, Any, Set, Tuple, Iterator, Iterable, Callable, Awaitable, AsyncIterator
 from multiprocessing.pool import Pool
+import lxml.html
+from lxml import etree
+from bs4 import SoupStrainer
 
 class Parser(Enum):
     LXML = 'lxml'
     HTMLPARSER = 'html.parser'
     HTML5LIB = 'html5lib'
+    # not a BeautifulSoup parser, a native lxml.html tree queried with Selector.
+    LXML_HTML = 'lxml.html'
+
+utf8_html_parser = lxml.html.HTMLParser(encoding='utf-8')
+
+class Region:
+    # an element a parser reads, matched the way a SoupStrainer matches it,
+    # Region('meta', attrs={'property': 'og:url'}) or Region(id='story') for any tag.
+    def __init__(self, tag: Optional[str]=None, id: Optional[str]=None, class_name: Optional[str]=None, attrs: Optional[Dict[str, str]]=None):
+        self.tag = tag
+        self.class_name = class_name
+        self.attrs = dict(attrs or {})
+        if id:
+            self.attrs['id'] = id
+
+    def match(self, tag: str, attrs: Optional[Dict[str, Any]]=None) -> bool:
+        if self.tag and tag != self.tag:
+            return False
+        if attrs is None:
+            # newer BeautifulSoup versions pass the tag name alone, the strainer then keeps a few more elements.
+            return True
+        if self.class_name:
+            classes = attrs.get('class') or ''
+            if self.class_name not in (classes.split() if isinstance(classes, str) else classes):
+                return False
+        return all(attrs.get(key) == value for key, value in self.attrs.items())
+
+def get_strainer(regions: List[Region]) -> SoupStrainer:
+    # BeautifulSoup(document, parser, parse_only=get_strainer(regions)) only builds the regions.
+    return SoupStrainer(lambda tag, attrs=None: any(region.match(tag, attrs) for region in regions))
+
+def parse_html(document: bytes, regions: Optional[List[Region]]=None, chunk_size: int=4096) -> lxml.html.HtmlElement:
+    # libxml2 only guesses the encoding from a meta tag, utf-8 is what BeautifulSoup would detect too.
+    try:
+        document.decode('utf-8')
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        encoding = None
+    if not regions:
+        return lxml.html.document_fromstring(document, parser=utf8_html_parser if encoding else None)
+
+    # feeds the document chunk by chunk and stops as soon as every region is closed,
+    # the rest of the page never becomes a tree. A missing region reads the whole page.
+    tags = {region.tag for region in regions}
+    parser = etree.HTMLPullParser(events=('end', ), tag=None if None in tags else list(tags), encoding=encoding)
+    parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
+    pending_regions = list(regions)
+    for index in range(0, len(document), chunk_size):
+        parser.feed(document[index:index + chunk_size])
+        for _, element in parser.read_events():
+            pending_regions = [region for region in pending_regions if not region.match(element.tag, element.attrib)]
+        if not pending_regions:
+            break
+    return parser.close()
+
+def has_class(name: str) -> str:
+    # the xpath of the css selector .name
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
+
+class Selector:
+    # declared once at module level, Selector('//h1/text()'), and compiled on its first use in every process.
+    def __init__(self, xpath: str):
+        self.xpath = xpath
+        self._compiled: Optional[etree.XPath] = None
+
+    def __call__(self, node: lxml.html.HtmlElement) -> List[Any]:
+        if self._compiled is None:
+            self._compiled = etree.XPath(self.xpath, smart_strings=False)
+        return self._compiled(node)
+
+    def first(self, node: lxml.html.HtmlElement, default: Any=None) -> Any:
+        results = self(node)
+        return results[0] if results else default
 
 Info = namedtuple('Info', ['next_info', 'retry_info'])
+# done holds the params parsed from a document, failed holds (param, error) pairs,
+# counts holds (param, records parsed or None) pairs of every param.
+ParsedChunk = namedtuple('ParsedChunk', ['data', 'infos', 'done', 'failed', 'counts'])
+# put by a fetch_worker task when it starts and when it ends, a process may run several of them.
+FetchTaskState = namedtuple('FetchTaskState', ['pid', 'finished'])
 logger = logging.getLogger('crawler_util')
 
+def get_param_url(param: Any) -> str:
+    # params are urls, or dicts with a url.
+    return param if isinstance(param, str) else param['url']
+
+def stream_async(
+        producer: Callable[[AsyncRequestUtil], AsyncIterator[Any]], 
+        logger: logging.Logger, 
+        session_options: Optional[Dict[str, Any]]=None
+    ) -> Iterator[Any]:
+    # runs an async producer with its own loop and session in a thread of the main process, and yields
+    # every item as soon as it is produced, e.g. as the inputs of crawl() while the pools already fetch.
+    produced: queue.Queue = queue.Queue()
+    done = object()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        session = AsyncRequestUtil(loop=loop, logger=logger, **(session_options or {}))
+
+        async def produce():
+            async for item in producer(session):
+                produced.put(item)
+
+        try:
+            loop.run_until_complete(produce())
+        except Exception as error:
+            logger.error(error)
+        finally:
+            loop.run_until_complete(session.close())
+            loop.close()
+            produced.put(done)
+
+    threading.Thread(target=run, name='stream_async', daemon=True).start()
+    while True:
+        item = produced.get()
+        if item is done:
+            return
+        yield item
+
+def get_worker_logger(queue: multiprocessing.Queue, name: str) -> logging.Logger:
+    sub_logger = logging.getLogger(name)
+    sub_logger.setLevel(logging.INFO)
+    if len(sub_logger.handlers) == 0 or not isinstance(sub_logger.handlers[0], logging.handlers.QueueHandler):
+        sub_logger.addHandler(logging.handlers.QueueHandler(queue))
+    return sub_logger
+
+class Worker:
+    # one event loop and one http session per pool process, shared by every request it handles.
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    session: Optional[AsyncRequestUtil] = None
+    logger: Optional[logging.Logger] = None
+    fetch_concurrency: int = 20
+    frontier: Optional[multiprocessing.Queue] = None
+    fetched: Optional[multiprocessing.Queue] = None
+    skip_unchanged: bool = False
+    # bodies with the same hash as the stored one of their param are not sent to the parse pool.
+    content_index: Optional[ContentIndex] = None
+    # columns of the storage, parse workers send records as tuples in this order.
+    columns: Optional[List[str]] = None
+    # the archive parse workers read pages from with CrawlerUtil.reparse().
+    page_archive: Optional[PageArchive] = None
+
+def init_worker(
+        queue: multiprocessing.Queue, 
+        name: str, 
+        session_options: Optional[Dict[str, Any]]=None, 
+        fetch_concurrency: int=20,
+        frontier: Optional[multiprocessing.Queue]=None,
+        fetched: Optional[multiprocessing.Queue]=None,
+        skip_unchanged: bool=False,
+        content_index: Optional[ContentIndex]=None,
+    ):
+    # Pool(initializer=init_worker, initargs=(logger_queue, site_name, {'main_page_url': main_page_url}))
+    Worker.logger = get_worker_logger(queue, name)
+    Worker.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(Worker.loop)
+    Worker.session = AsyncRequestUtil(loop=Worker.loop, logger=Worker.logger, **(session_options or {}))
+    # target of in-flight requests of this process.
+    Worker.fetch_concurrency = fetch_concurrency
+    Worker.frontier = frontier
+    Worker.fetched = fetched
+    Worker.skip_unchanged = skip_unchanged
+    Worker.content_index = content_index
+    # runs when the process exits after pool.close(), not after pool.terminate().
+    Finalize(Worker, close_worker, exitpriority=10)
+
+def close_worker():
+    if Worker.session is None:
+        return
+    try:
+        Worker.loop.run_until_complete(Worker.session.close())
+        Worker.loop.run_until_complete(Worker.loop.shutdown_default_executor())
+    except Exception as error:
+        Worker.logger.error(error)
+    finally:
+        Worker.loop.close()
+        Worker.session = None
+
+def init_parse_worker(queue: multiprocessing.Queue, name: str, columns: Optional[List[str]]=None):
+    # Pool(initializer=init_parse_worker, initargs=(logger_queue, site_name, database.columns))
+    Worker.logger = get_worker_logger(queue, name)
+    Worker.columns = columns
+
+def check_content(param: Any, document: bytes, stats: Dict[str, Any]) -> Tuple[Optional[bytes], Optional[bytes]]:
+    # returns the hash of the body, and the body unless it is the one stored by an earlier run.
+    try:
+        content_hash = ContentIndex.get_hash(document)
+        if Worker.content_index.is_unchanged(param, content_hash):
+            stats['same_content'] += 1
+            stats['same_content_bytes'] += len(document)
+            return content_hash, None
+        return content_hash, document
+    except Exception as error:
+        Worker.logger.error(error)
+        return None, document
+
+def fetch_worker(fetch_function: Callable[[AsyncRequestUtil, Any], Awaitable[Optional[bytes]]]) -> Dict[str, Any]:
+    # runs inside a fetch worker until the frontier is exhausted, keeps fetch_concurrency requests
+    # in flight and pulls the next url as soon as any of them finishes.
+    stats = {
+        'pid': os.getpid(), 'slots': Worker.fetch_concurrency, 'requests': 0, 'unchanged': 0, 
+        'same_content': 0, 'same_content_bytes': 0, 
+        'busy_seconds': 0.0, 'wall_seconds': 0.0
+    }
+    Worker.fetched.put(FetchTaskState(os.getpid(), False))
+    slots = asyncio.Semaphore(Worker.fetch_concurrency)
+
+    async def fetch(param: Any):
+        started = time.monotonic()
+        document = None
+        fetch_error = None
+        content_hash = None
+        # every task runs in its own copy of the context.
+        archive_param.set(param)
+        try:
+            document = await fetch_function(Worker.session, param)
+        except Exception as error:
+            Worker.logger.error(error)
+            fetch_error = repr(error)
+        finally:
+            stats['requests'] += 1
+            stats['busy_seconds'] += time.monotonic() - started
+            if document is None and fetch_error is None:
+                fetch_error = 'No response'
+            # a page the cache says is unchanged has already been parsed and saved by an earlier run.
+            if Worker.skip_unchanged and getattr(document, 'not_modified', False):
+                stats['unchanged'] += 1
+                document = None
+            if Worker.content_index and document is not None and fetch_error is None:
+                content_hash, document = check_content(param, document, stats)
+            Worker.fetched.put((document, param, fetch_error, content_hash))
+            slots.release()
+
+    async def run():
+        tasks = set()
+        while True:
+            await slots.acquire()
+            param = await Worker.loop.run_in_executor(None, Worker.frontier.get)
+            if param is None:
+                break
+            task = Worker.loop.create_task(fetch(param))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    started = time.monotonic()
+    try:
+        Worker.loop.run_until_complete(run())
+    except Exception as error:
+        Worker.logger.error(error)
+    finally:
+        stats['wall_seconds'] = time.monotonic() - started
+        # tells the collector this task is done.
+        Worker.fetched.put(FetchTaskState(os.getpid(), True))
+    return stats
+
+def parse_chunk(
+        parse_function: Callable[[logging.Logger, Optional[bytes], Any], Tuple[List[Dict[str, Any]], Optional[Info]]], 
+        fetched_chunk: List[Tuple[Optional[bytes], Any]]
+    ) -> ParsedChunk:
+    # runs inside a parse worker.
+    data_of_urls = []
+    info_of_urls = []
+    done = []
+    failed = []
+    counts = []
+    for document, param in fetched_chunk:
+        try:
+            data_per_url, info = parse_function(Worker.logger, document, param)
+        except Exception as error:
+            Worker.logger.error(error)
+            failed.append((param, repr(error)))
+            counts.append((param, None))
+            # the param itself goes to the retry log, as if the parse function had returned it.
+            info_of_urls.append(Info(next_info=None, retry_info=param))
+            continue
+        counts.append((param, len(data_per_url or []) if document is not None else None))
+        if data_per_url and Worker.columns:
+            # tuples don't pickle the keys of every record again.
+            data_of_urls.extend(tuple(map(record.get, Worker.columns)) for record in data_per_url)
+        elif data_per_url:
+            data_of_urls.extend(data_per_url)
+        if info:
+            info_of_urls.append(info)
+        if document is not None:
+            done.append(param)
+    return ParsedChunk(data_of_urls, info_of_urls, done, failed, counts)
+
+def parse_archived_chunk(
+        parse_function: Callable[[logging.Logger, Optional[bytes], Any], Tuple[List[Dict[str, Any]], Optional[Info]]], 
+        page_archive: PageArchive,
+        entries: List[ArchiveEntry]
+    ) -> ParsedChunk:
+    # runs inside a parse worker, which maps the archive once and reads the pages itself.
+    if Worker.page_archive is None or Worker.page_archive.file_path != page_archive.file_path:
+        Worker.page_archive = page_archive
+    fetched_chunk = []
+    for entry in entries:
+        document = None
+        try:
+            document = Worker.page_archive.read(entry)
+        except Exception as error:
+            Worker.logger.error(error)
+        fetched_chunk.append((document, entry.param))
+    return parse_chunk(parse_function, fetched_chunk)
+
 class CrawlerUtil:
 
-    database: Union[DatabaseUtil, JsonUtil, CsvUtil, None] = None
+    database: Union[DatabaseUtil, JsonUtil, JsonLinesUtil, CsvUtil, ParquetUtil, None] = None
     
-    def __init__(self, database: Union[DatabaseUtil, JsonUtil, CsvUtil]) -> None:
-        self.collected_data = []
+    def __init__(
+            self, 
+            database: Union[DatabaseUtil, JsonUtil, JsonLinesUtil, CsvUtil, ParquetUtil], 
+            batch_size: int=500, 
+            flush_interval: float=5.0, 
+            max_queue_size: int=64,
+            persistent_frontier: Optional[PersistentFrontier]=None,
+            retry_log: Optional[RetryLog]=None,
+            parse_batch_size: int=8,
+        ) -> None:
+        self.batch_size = batch_size
+        # most fetched documents handed to one parse task, only what is already waiting.
+        self.parse_batch_size = parse_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.writer: Optional[BackgroundWriter] = None
         self.retry_info = []
+        # the background writer adds the params of batches it failed to save.
+        self.retry_lock = threading.Lock()
+        self.retry_log = retry_log if retry_log is not None else RetryLog()
+        # params parsed during replay_retries.
+        self.replayed: Optional[List[Any]] = None
+        self.paginator: Optional[Paginator] = None
         self.total_count = 0
+        # keeps the status of every param of crawl() on disk, so an interrupted run can be resumed.
+        self.persistent_frontier = persistent_frontier
+        # set by create_pools, bodies parsed by this run wait here for their hash until their records are saved.
+        self.content_index: Optional[ContentIndex] = None
+        self.content_hashes: Dict[str, List[Any]] = {}
+        self.content_stats = {'same': 0, 'changed': 0, 'records': 0}
         self.__class__.database = database
 
-    def set_database(self, database: Union[DatabaseUtil, JsonUtil, CsvUtil]):
+    def set_database(self, database: Union[DatabaseUtil, JsonUtil, JsonLinesUtil, CsvUtil, ParquetUtil]):
         self.__class__.database = database
 
-    def extend(self, data: List[Dict[str, Any]]):
-        self.collected_data.extend(data)
-        if len(self.collected_data) >= 500:
-            self.save()
+    def start_writer(self):
+        # started once the pools are forked, so no writer thread is alive while a pool forks.
+        if self.writer is None:
+            self.writer = BackgroundWriter(
+                self.database, 
+                batch_size=self.batch_size, 
+                flush_interval=self.flush_interval, 
+                max_queue_size=self.max_queue_size,
+                on_saved=self._on_saved if self.persistent_frontier or self.content_index else None,
+                on_failed=self._on_save_failed
+            )
+
+    def extend(self, data: List[Dict[str, Any]], done: Optional[List[Any]]=None):
+        self.start_writer()
+        self.writer.put(data, done)
 
     def save(self):
-        self.total_count += len(self.collected_data)
-        logger.info("Saved %s into database", len(self.collected_data))
-        self.database.save(self.collected_data)
-        self.collected_data = []
+        if self.writer is None:
+            return
+        self.total_count += self.writer.close()
+        self.writer = None
+        # params of batches the writer failed to save.
+        if self.retry_info:
+            self.save_retry_info()
 
     def save_retry_info(self):
-        retry_info_file_path = 'retry_info.json'
-        previous_retry_info = []
-        if os.path.isfile(retry_info_file_path):
-            with open(retry_info_file_path, 'r') as openfile: 
-                previous_retry_info = json.load(openfile)
-        previous_retry_info.extend(self.retry_info)
-        with open(retry_info_file_path, 'w', encoding='utf-8') as f:
-            json.dump(previous_retry_info, f, ensure_ascii=False)
-        self.retry_info = []
+        with self.retry_lock:
+            retry_info = self.retry_info
+            self.retry_info = []
+        self.retry_log.append(retry_info)
 
     def reset(self):
-        self.collected_data = []
+        self.save()
         self.retry_info = []
         self.total_count = 0
 
-    def close(self, pool: Pool):
-        pool.terminate()
+    def close(self, *pools: Pool):
+        for pool in pools:
+            # let workers close their sessions, imap already terminated the pool on failure.
+            pool.close()
+            pool.join()
+        self.save()
+        self.database.close()
+        if self.persistent_frontier:
+            self.persistent_frontier.close()
+        if self.content_index:
+            self.content_index.close()
+
+    def create_pools(
+            self, 
+            crawler_config: 'CrawlerConfig', 
+            name: str, 
+            session_options: Optional[Dict[str, Any]]=None
+        ) -> Tuple[Pool, Pool]:
+        session_options = dict(session_options or {})
+        if crawler_config.retry_policy:
+            session_options.setdefault('retry_policy', crawler_config.retry_policy)
+        if crawler_config.rate_limiter:
+            session_options.setdefault('rate_limiter', crawler_config.rate_limiter)
+        if crawler_config.adaptive_concurrency:
+            # copied into every process by fork, each process adapts its own limit.
+            session_options.setdefault('concurrency_controller', ConcurrencyController(
+                initial_limit=max(1, crawler_config.fetch_concurrency // 4), 
+                max_limit=crawler_config.fetch_concurrency
+            ))
+        if crawler_config.response_cache:
+            session_options.setdefault('response_cache', crawler_config.response_cache)
+        if crawler_config.page_archive:
+            session_options.setdefault('page_archive', crawler_config.page_archive)
+        # queues are shared through inheritance, so they must exist before the pools fork.
+        self.frontier = multiprocessing.Queue(maxsize=crawler_config.process_num * crawler_config.fetch_concurrency)
+        self.fetched = multiprocessing.Queue()
+        fetch_pool = Pool(
+            processes=crawler_config.process_num, 
+            initializer=init_worker, 
+            initargs=(
+                crawler_config.logger_queue, 
+                name, 
+                session_options, 
+                crawler_config.fetch_concurrency, 
+                self.frontier, 
+                self.fetched,
+                crawler_config.skip_unchanged,
+                crawler_config.content_index
+            )
+        )
+        parse_pool = self.create_parse_pool(crawler_config, name)
+        self.fetch_process_num = crawler_config.process_num
+        self.content_index = crawler_config.content_index
+        return fetch_pool, parse_pool
+
+    def create_parse_pool(self, crawler_config: 'CrawlerConfig', name: str) -> Pool:
+        # the only pool reparse() needs.
+        return Pool(
+            processes=crawler_config.parse_workers, 
+            initializer=init_parse_worker, 
+            initargs=(crawler_config.logger_queue, name, self.database.columns)
+        )
+
+    def crawl(
+            self, 
+            fetch_pool: Pool, 
+            parse_pool: Pool, 
+            fetch_function: Callable[[AsyncRequestUtil, Any], Awaitable[Optional[bytes]]], 
+            parse_function: Callable[[logging.Logger, Optional[bytes], Any], Tuple[List[Dict[str, Any]], Optional[Info]]], 
+            inputs: Iterable[Any],
+            paginator: Optional[Paginator]=None,
+        ) -> List[Any]:
+        # fetch workers pull urls from the shared frontier, the parse pool pulls whatever they fetched.
+        # inputs made by paginator.paginate() are told how many records each page had.
+        all_next_info = []
+        self.paginator = paginator
+        self.content_stats = {'same': 0, 'changed': 0, 'records': 0}
+        if self.persistent_frontier:
+            inputs = self.persistent_frontier.track(inputs, on_skipped=self._on_skipped)
+        # both the collector and the task handler thread of the parse pool put into the writer.
+        self.start_writer()
+        fetch_results = [fetch_pool.apply_async(fetch_worker, (fetch_function, )) for _ in range(self.fetch_process_num)]
+        feeder = threading.Thread(target=self._feed, args=(inputs, ), name='frontier_feeder', daemon=True)
+        feeder.start()
+        # _iter_fetched runs on the task handler thread of the parse pool, which terminate() waits for.
+        stop = threading.Event()
+        dead_pids: Set[int] = set()
+        results = parse_pool.imap_unordered(
+            partial(parse_chunk, parse_function), self._iter_fetched(fetch_pool, len(fetch_results), stop, dead_pids)
+        )
+        try:
+            self._collect(results, all_next_info)
+        except BaseException:
+            stop.set()
+            fetch_pool.terminate()
+            parse_pool.terminate()
+            raise
+        finally:
+            self.paginator = None
+        if dead_pids:
+            # the pool would wait for the lost tasks forever when it is closed.
+            fetch_pool.terminate()
+            raise RuntimeError('Fetch workers {} died, resume the run to fetch their params again.'.format(sorted(dead_pids)))
+        same_content_bytes = 0
+        for fetch_result in fetch_results:
+            stats = fetch_result.get()
+            same_content_bytes += stats['same_content_bytes']
+            self._log_utilisation(stats)
+        if self.content_index:
+            logger.info(
+                "Content index: %s pages unchanged, %.1f MB not parsed and %s records not written again, %s pages new or changed", 
+                self.content_stats['same'], same_content_bytes / 1024 / 1024, self.content_stats['records'], self.content_stats['changed']
+            )
+        if paginator:
+            logger.info("Paginator requested %s pages", paginator.requested_count)
+        if self.persistent_frontier:
+            # the writer marks the last params done when it is closed.
+            self.save()
+            logger.info("Frontier: %s", self.persistent_frontier.counts())
+        if self.retry_info:
+            self.save_retry_info()
+        return all_next_info
+
+    def replay_retries(
+            self, 
+            fetch_pool: Pool, 
+            parse_pool: Pool, 
+            fetch_function: Callable[[AsyncRequestUtil, Any], Awaitable[Optional[bytes]]], 
+            parse_function: Callable[[logging.Logger, Optional[bytes], Any], Tuple[List[Dict[str, Any]], Optional[Info]]]
+        ) -> List[Any]:
+        # streams the retry log through crawl(), then drops every param that succeeded from it.
+        logger.info("Replaying %s params of %s", len(self.retry_log), self.retry_log.file_path)
+        self.replayed = []
+        try:
+            all_next_info = self.crawl(fetch_pool, parse_pool, fetch_function, parse_function, iter(self.retry_log))
+            # the rows must be saved before their params leave the log.
+            self.save()
+            left_count = self.retry_log.compact(self.replayed)
+            logger.info("Replay parsed %s params, %s left in %s", len(self.replayed), left_count, self.retry_log.file_path)
+        finally:
+            self.replayed = None
+        return all_next_info
 
-    def imap(self, pool: Pool, function: Callable[[Any], Any], inputs: List[Any]) -> List[Any]:
+    def reparse(
+            self, 
+            parse_pool: Pool, 
+            parse_function: Callable[[logging.Logger, Optional[bytes], Any], Tuple[List[Dict[str, Any]], Optional[Info]]], 
+            page_archive: PageArchive
+        ) -> List[Any]:
+        # parses the latest archived page of every param again into the storage, without any request.
+        logger.info("Reparsing %s pages of %s", page_archive.count(), page_archive.data_path)
         all_next_info = []
-        results: Iterator[Union[Tuple[List[Any], List[Info]], List[Any]]] = \
-            pool.imap_unordered(function, inputs, )
+        results = parse_pool.imap_unordered(partial(parse_archived_chunk, parse_function, page_archive), self._iter_archived(page_archive))
+        try:
+            self._collect(results, all_next_info)
+        except BaseException:
+            parse_pool.terminate()
+            raise
+        if self.retry_info:
+            self.save_retry_info()
+        return all_next_info
+
+    def crawl_links(
+            self, 
+            fetch_pool: Pool, 
+            parse_pool: Pool, 
+            fetch_function: Callable[[AsyncRequestUtil, Any], Awaitable[Optional[bytes]]], 
+            parse_function: Callable[[logging.Logger, Optional[bytes], Any], Tuple[List[Dict[str, Any]], Optional[Info]]], 
+            seeds: Iterable[Any],
+            seen_urls: SeenUrls,
+            max_depth: int=2,
+            allowed_domains: Optional[List[str]]=None,
+            get_url: Callable[[Any], str]=get_param_url,
+        ) -> int:
+        # breadth first, the params parsers put into Info.next_info (one or a list per page) are the next level.
+        # returns how many params were crawled.
+        crawled_count = 0
+        level = list(seeds)
+        for depth in range(max_depth + 1):
+            params = []
+            for next_info in level:
+                for param in (next_info if isinstance(next_info, list) else [next_info]):
+                    url = get_url(param)
+                    if self._is_allowed(url, allowed_domains) and seen_urls.add(url):
+                        params.append(param)
+            seen_urls.commit()
+            if not params:
+                break
+            logger.info("Depth %s: %s new params, %s seen", depth, len(params), len(seen_urls))
+            level = self.crawl(fetch_pool, parse_pool, fetch_function, parse_function, params)
+            crawled_count += len(params)
+            if depth == max_depth and level:
+                logger.info("Depth limit %s reached, %s next params left", max_depth, len(level))
+        return crawled_count
+
+    def _is_allowed(self, url: str, allowed_domains: Optional[List[str]]) -> bool:
+        if not allowed_domains:
+            return True
+        host = urlsplit(url).hostname or ''
+        return any(host == domain or host.endswith('.' + domain) for domain in allowed_domains)
+
+    def _on_skipped(self, param: Any):
+        # done by the run this one resumes.
+        if self.paginator:
+            self.paginator.on_page(param, None)
+
+    def _feed(self, inputs: Iterable[Any]):
+        for param in inputs:
+            self.frontier.put(param)
+        for _ in range(self.fetch_process_num):
+            self.frontier.put(None)
+
+    def _read_fetched(self, fetched: queue.Queue, stop: threading.Event):
+        # a worker killed while writing into the shared pipe leaves half a message, which blocks its reader
+        # for good, so only this thread reads it and _iter_fetched can still notice the dead worker.
+        while not stop.is_set():
+            try:
+                fetched.put(self.fetched.get(timeout=0.2))
+            except queue.Empty:
+                continue
+
+    def _iter_fetched(
+            self, 
+            fetch_pool: Pool, 
+            task_num: int, 
+            stop: threading.Event, 
+            dead_pids: Set[int]
+        ) -> Iterator[List[Tuple[Optional[bytes], Any]]]:
+        # ends once every fetch_worker task said it is done, or as soon as a process running one died,
+        # which may have left the shared queues locked. dead_pids gets those processes.
+        fetched_queue: queue.Queue = queue.Queue()
+        reader_stop = threading.Event()
+        reader = threading.Thread(target=self._read_fetched, args=(fetched_queue, reader_stop), name='fetched_reader', daemon=True)
+        reader.start()
+        # fetch_worker tasks each process is running.
+        running: Dict[int, int] = {}
+        finished_num = 0
+        try:
+            while finished_num < task_num:
+                if stop.is_set():
+                    return
+                try:
+                    fetched = fetched_queue.get(timeout=1)
+                except queue.Empty:
+                    # the pool replaces a killed worker, but the tasks it ran are lost with it.
+                    alive_pids = {worker.pid for worker in list(fetch_pool._pool) if worker.is_alive()}
+                    for pid, count in running.items():
+                        if count and pid not in alive_pids:
+                            logger.error("Fetch worker %s died running %s fetch tasks", pid, count)
+                            dead_pids.add(pid)
+                    if dead_pids:
+                        return
+                    continue
+                fetched_chunk = []
+                # takes whatever else is already fetched, but never waits for more.
+                while True:
+                    if isinstance(fetched, FetchTaskState):
+                        if fetched.finished:
+                            finished_num += 1
+                            running[fetched.pid] -= 1
+                        else:
+                            running[fetched.pid] = running.get(fetched.pid, 0) + 1
+                    else:
+                        self._accept_fetched(fetched, fetched_chunk)
+                    if len(fetched_chunk) >= self.parse_batch_size or finished_num >= task_num:
+                        break
+                    try:
+                        fetched = fetched_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if fetched_chunk:
+                    yield fetched_chunk
+        finally:
+            reader_stop.set()
+            # the next crawl must not share the queue with this reader. A reader blocked by a killed worker
+            # is left behind, the run stops then anyway.
+            if finished_num >= task_num:
+                reader.join()
+
+    def _iter_archived(self, page_archive: PageArchive) -> Iterator[List[ArchiveEntry]]:
+        entries = []
+        for entry in page_archive.entries():
+            entries.append(entry)
+            if len(entries) >= self.parse_batch_size:
+                yield entries
+                entries = []
+        if entries:
+            yield entries
+
+    def _accept_fetched(self, fetched: Tuple[Optional[bytes], Any, Optional[str], Optional[bytes]], fetched_chunk: List[Tuple[Optional[bytes], Any]]):
+        document, param, fetch_error, content_hash = fetched
+        if document is None and fetch_error is None:
+            # unchanged page, nothing to parse.
+            count = None
+            if content_hash is not None:
+                # the same body as the stored one, so the paginator is told its stored count.
+                stored = self.content_index.lookup(param)
+                count = stored[1] if stored else None
+                self.content_index.touch(param)
+                self.content_stats['same'] += 1
+                self.content_stats['records'] += count or 0
+            if self.paginator:
+                self.paginator.on_page(param, count)
+            if self.persistent_frontier:
+                self.extend([], [param])
+            return
+        if content_hash is not None:
+            self.content_stats['changed'] += 1
+            self.content_hashes[param_key(param)] = [content_hash, None]
+        if fetch_error:
+            self.retry_info.append(param)
+            if self.persistent_frontier:
+                self.persistent_frontier.mark_failed(param, fetch_error)
+        fetched_chunk.append((document, param))
+
+    def _on_saved(self, done: List[Any]):
+        # called by the background writer once the records of these params are saved.
+        if self.persistent_frontier:
+            self.persistent_frontier.mark_done(done)
+        if self.content_index:
+            contents = []
+            for param in done:
+                content = self.content_hashes.pop(param_key(param), None)
+                if content and content[1] is not None:
+                    contents.append((param, content[0], content[1]))
+            if contents:
+                self.content_index.update(contents)
+
+    def _on_save_failed(self, done: List[Any], error: str):
+        # called by the background writer when the records of these params couldn't be saved,
+        # so they are crawled again by --resume or --replay_retries.
+        if self.persistent_frontier:
+            for param in done:
+                self.persistent_frontier.mark_failed(param, error)
+        if self.content_index:
+            # their bodies must not count as stored, or a later run would skip them as unchanged.
+            for param in done:
+                self.content_hashes.pop(param_key(param), None)
+        with self.retry_lock:
+            self.retry_info.extend(done)
+
+    def _log_utilisation(self, stats: Dict[str, Any]):
+        slot_seconds = stats['wall_seconds'] * stats['slots']
+        utilisation = stats['busy_seconds'] / slot_seconds if slot_seconds else 0.0
+        logger.info(
+            "Fetch worker %s: %s requests in %.1fs, %.1f%% of its slots busy, %s unchanged pages and %s same bodies skipped", 
+            stats['pid'], stats['requests'], stats['wall_seconds'], utilisation * 100, stats['unchanged'], stats['same_content']
+        )
+
+    def _collect(self, results: Iterator[Union[ParsedChunk, Tuple[List[Any], List[Info]], List[Any]]], all_next_info: List[Any]):
         for result in results:
             collected_data = []
+            done = None
+            if isinstance(result, ParsedChunk):
+                done = result.done
+                if self.paginator:
+                    for param, count in result.counts:
+                        self.paginator.on_page(param, count)
+                if self.replayed is not None:
+                    self.replayed.extend(done)
+                if self.persistent_frontier:
+                    for param, error in result.failed:
+                        self.persistent_frontier.mark_failed(param, error)
+                if self.content_hashes:
+                    for param, count in result.counts:
+                        content = self.content_hashes.get(param_key(param))
+                        if content:
+                            content[1] = count
+                    for param, _ in result.failed:
+                        self.content_hashes.pop(param_key(param), None)
             if isinstance(result, tuple):
-                data_of_urls, info_of_urls = result
+                data_of_urls, info_of_urls = result[:2]
                 if info_of_urls:
                     for info in info_of_urls:
                         if info.retry_info:
@@ -77,15 +798,38 @@ class CrawlerUtil:
                 collected_data = data_of_urls
             else:
                 collected_data = result
-            if len(collected_data):
-                self.extend(collected_data)
-        if self.retry_info:
-            self.save_retry_info()
-        return all_next_info
+            if len(collected_data) or done:
+                self.extend(collected_data, done)
 
 class CrawlerConfig:
-    def __init__(self, crawler_util: Optional[CrawlerUtil]=None, logger_queue: Optional[multiprocessing.Queue] = None, process_num: Optional[int]=None, chunk_size: Optional[int]=None) -> None:
+    def __init__(
+            self, 
+            crawler_util: Optional[CrawlerUtil]=None, 
+            logger_queue: Optional[multiprocessing.Queue] = None, 
+            process_num: Optional[int]=None, 
+            fetch_concurrency: int=20,
+            parse_workers: Optional[int]=None,
+            rate_limiter: Optional[SharedRateLimiter]=None,
+            adaptive_concurrency: bool=False,
+            response_cache: Optional[ResponseCache]=None,
+            skip_unchanged: bool=False,
+            retry_policy: Optional[RetryPolicy]=None,
+            page_archive: Optional[PageArchive]=None,
+            content_index: Optional[ContentIndex]=None,
+        ) -> None:
         self.crawler_util = crawler_util
         self.process_num = process_num
-        self.chunk_size = chunk_size
+        self.fetch_concurrency = fetch_concurrency
+        self.parse_workers = parse_workers
+        self.rate_limiter = rate_limiter
+        # fetch_concurrency becomes the ceiling of an AIMD controlled limit.
+        self.adaptive_concurrency = adaptive_concurrency
+        self.response_cache = response_cache
+        # only safe when the storage keeps the rows of earlier runs.
+        self.skip_unchanged = skip_unchanged
+        self.retry_policy = retry_policy
+        # fetch workers keep every page they fetch in it.
+        self.page_archive = page_archive
+        # like skip_unchanged, only safe when the storage keeps the rows of earlier runs.
+        self.content_index = content_index
         self.logger_queue = logger_queue
\ No newline at end of file
@@ -3,53 +3,132 @@ import os
 from pathlib import Path
 import json
 from datetime import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, insert, select, text
+from sqlalchemy import Boolean, Date, DateTime, Integer, Numeric
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
 import csv
+import operator
+import queue
+import threading
+import time
 from enum import Enum
-from typing import Optional, Union, List, Dict, Any
+from typing import Optional, Union, List, Dict, Any, Set, Callable, Tuple
 from sqlalchemy.orm.decl_api import DeclarativeMeta
-from sqlalchemy.engine.base import Engine
+from sqlalchemy.engine.base import Engine, Connection
 from sqlalchemy.orm.session import Session
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # only DataBaseType.PARQUET needs it.
+    pyarrow = None
 
 logger = logging.getLogger('database')
 
+# a dict, or a tuple ordered like the columns of the storage.
+Record = Union[Dict[str, Any], Tuple[Any, ...]]
+
 class DataBaseType(Enum):
     DATABASE = 'DATABASE' # init_database(database_type=DataBaseType.DATABASE, site_name=site_name, fields=GlobalWifi)
     JSON = 'JSON' # init_database(database_type=DataBaseType.JSON, site_name=site_name, fields=None)
     CSV = 'CSV' #  init_database(database_type=DataBaseType.CSV, site_name=site_name, fields=['title', 'id'])
+    JSONL = 'JSONL' # init_database(database_type=DataBaseType.JSONL, site_name=site_name, fields=None, export_json=True)
+    PARQUET = 'PARQUET' # init_database(database_type=DataBaseType.PARQUET, site_name=site_name, fields=YahooMovie)
 
 class DatabaseUtil:
-    def __init__(self, table: DeclarativeMeta, file_path: str=''):
+    def __init__(
+            self, 
+            table: DeclarativeMeta, 
+            file_path: str='', 
+            synchronous: str='NORMAL', 
+            cache_size: int=-64000, 
+            natural_key: Optional[str]=None
+        ):
         self.extension = '.sqlite3'
         self.table = table
         self.file_path = file_path
+        self.synchronous = synchronous
+        # negative value means KiB instead of pages.
+        self.cache_size = cache_size
+        # column identifying a record across runs, rows with a known key are updated instead of inserted.
+        self.natural_key = natural_key
+        self._connection: Optional[Connection] = None
 
         try:
             Path(self.file_path + self.extension).touch()
-            self.engine: Engine = create_engine('sqlite:///{}'.format(self.file_path + self.extension))
+            self.engine: Engine = create_engine(
+                'sqlite:///{}'.format(self.file_path + self.extension),
+                connect_args={'check_same_thread': False},
+            )
+            event.listen(self.engine, 'connect', self.set_pragmas)
             self.table.metadata.create_all(self.engine)
+            if self.natural_key:
+                # files of earlier runs get the index on their first incremental run.
+                with self.engine.begin() as connection:
+                    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(
+                        self.table.__tablename__, self.natural_key
+                    )))
         except Exception as error:
             logger.critical(error)
             exit()
 
+        # every row must carry the same keys for executemany, let sqlite fill the surrogate key.
+        self.columns = [column.name for column in self.table.__table__.columns if not column.primary_key]
+        self.insert_statement = insert(self.table.__table__)
+        if self.natural_key:
+            statement = sqlite_insert(self.table.__table__)
+            self.insert_statement = statement.on_conflict_do_update(
+                index_elements=[self.natural_key],
+                set_={column: statement.excluded[column] for column in self.columns if column != self.natural_key}
+            )
+
+    def set_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous={}'.format(self.synchronous))
+        cursor.execute('PRAGMA cache_size={}'.format(self.cache_size))
+        cursor.close()
+
     @property
     def session(self) -> Session:
         Session = sessionmaker(bind=self.engine)
         _session = Session()
         return _session
 
-    def save(self, data: List[Dict[str, Any]]):
-        try:
-            session = self.session
-            session.bulk_insert_mappings(self.table, data)
-            session.commit()
-        except Exception as error:
-            logger.error(error)
-        finally:
-            session.close()
+    @property
+    def connection(self) -> Connection:
+        if self._connection is None or self._connection.closed:
+            self._connection = self.engine.connect()
+        return self._connection
+
+    def save(self, data: List[Record]):
+        if not data:
+            return
+        rows = [
+            dict(zip(self.columns, record)) if isinstance(record, tuple) else {column: record.get(column) for column in self.columns} 
+            for record in data
+        ]
+        with self.connection.begin():
+            self.connection.execute(self.insert_statement, rows)
+
+    def load_keys(self) -> Set[Any]:
+        if not self.natural_key:
+            return set()
+        column = self.table.__table__.c[self.natural_key]
+        with self.engine.connect() as connection:
+            return {row[0] for row in connection.execute(select(column).where(column.isnot(None)))}
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        self.engine.dispose()
 
 class JsonUtil:
+    # without a schema, records are kept as dicts.
+    columns: Optional[List[str]] = None
+
     def __init__(self, file_path: str=''):
         self.extension = '.json'
         self.file_path = file_path
@@ -64,37 +143,295 @@ class JsonUtil:
             pass
         
         with open(self.file_path + '_tmp' + self.extension, 'w', encoding='utf-8') as json_file:
-            try:
-                origin_data.extend(data)
-                json.dump(origin_data, json_file, ensure_ascii=False)
-                os.rename(self.file_path + '_tmp' + self.extension, self.file_path + self.extension)
-            except Exception as error:
-                logger.error(error)
+            origin_data.extend(data)
+            json.dump(origin_data, json_file, ensure_ascii=False)
+            os.rename(self.file_path + '_tmp' + self.extension, self.file_path + self.extension)
+
+    def close(self):
+        pass
+
+class JsonLinesUtil:
+    columns: Optional[List[str]] = None
+
+    def __init__(self, file_path: str='', fsync_interval: int=10, buffer_size: int=1024 * 1024, export_json: bool=False):
+        self.extension = '.jsonl'
+        self.file_path = file_path
+        # fsync once every n batches, the os page cache absorbs the rest.
+        self.fsync_interval = fsync_interval
+        self.export_json = export_json
+        self.unsynced_batches = 0
+        self.file = open(self.file_path + self.extension, 'a', encoding='utf-8', buffering=buffer_size)
+
+    def save(self, data: List[Dict[str, Any]]):
+        if not data:
+            return
+        lines = ''.join([json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in data])
+        self.file.write(lines)
+        self.file.flush()
+        self.unsynced_batches += 1
+        if self.unsynced_batches >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced_batches = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.flush()
+        self.sync()
+        self.file.close()
+        if self.export_json:
+            export_json_array(self.file_path + self.extension, self.file_path + '.json')
+
+def export_json_array(jsonl_file_path: str, json_file_path: str):
+    # stream line by line, never hold the whole dataset in memory.
+    tmp_file_path = json_file_path + '_tmp'
+    try:
+        with open(jsonl_file_path, 'r', encoding='utf-8') as jsonl_file, \
+                open(tmp_file_path, 'w', encoding='utf-8') as json_file:
+            json_file.write('[')
+            separator = ''
+            for line in jsonl_file:
+                line = line.strip()
+                if not line:
+                    continue
+                json_file.write(separator)
+                json_file.write(line)
+                separator = ','
+            json_file.write(']')
+        os.rename(tmp_file_path, json_file_path)
+    except Exception as error:
+        logger.error(error)
 
 class CsvUtil:
-    def __init__(self, file_path: str='', field_names: List[str]=[]):
+    def __init__(self, file_path: str='', field_names: List[str]=[], max_bytes: int=0, buffer_size: int=1024 * 1024):
         self.extension = '.csv'
         self.file_path = file_path
+        self.field_names = list(field_names)
+        self.columns = self.field_names
+        # rotate to a new file once the current one grows over max_bytes, 0 means never.
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.file_index = 0
+        self.file = None
+        self.writer = None
+        if len(self.field_names) == 1:
+            field_name = self.field_names[0]
+            self.row_getter = lambda record: (record[field_name], )
+        else:
+            self.row_getter = operator.itemgetter(*self.field_names)
+        self.open()
+
+    @property
+    def current_file_path(self) -> str:
+        if self.file_index:
+            return '{}_{}{}'.format(self.file_path, self.file_index, self.extension)
+        return self.file_path + self.extension
+
+    def read_header(self, file_path: str) -> Optional[List[str]]:
+        with open(file_path, 'r', newline='', encoding='utf-8') as csv_file:
+            return next(csv.reader(csv_file), None)
+
+    def open(self):
+        # skip files written with another schema instead of appending misaligned columns.
+        while os.path.isfile(self.current_file_path) and os.path.getsize(self.current_file_path) > 0:
+            if self.read_header(self.current_file_path) == self.field_names and not self.is_full():
+                break
+            self.file_index += 1
+
+        self.file = open(self.current_file_path, 'a', newline='', encoding='utf-8', buffering=self.buffer_size)
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(self.field_names)
+
+    def is_full(self) -> bool:
+        return bool(self.max_bytes) and os.path.getsize(self.current_file_path) >= self.max_bytes
+
+    def rotate(self):
+        self.file.close()
+        self.file_index += 1
+        self.open()
 
     def save(self, data: List[Dict[str, Any]]):
-        origin_data = []
-        
+        if not data:
+            return
+        try:
+            rows = [record if isinstance(record, tuple) else self.row_getter(record) for record in data]
+        except KeyError:
+            rows = [
+                record if isinstance(record, tuple) else [record.get(field_name, '') for field_name in self.field_names] 
+                for record in data
+            ]
+        self.writer.writerows(rows)
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def close(self):
+        if self.file and not self.file.closed:
+            self.file.close()
+
+def get_arrow_type(column_type: Any) -> 'pyarrow.DataType':
+    if isinstance(column_type, Integer):
+        return pyarrow.int64()
+    if isinstance(column_type, Numeric):
+        return pyarrow.float64()
+    if isinstance(column_type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column_type, Date):
+        return pyarrow.date32()
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    # String, Text and anything else.
+    return pyarrow.string()
+
+class ParquetUtil:
+    # columnar storage of a declarative table. Batches are converted to arrow columns as they come,
+    # and written as one compressed row group once row_group_size rows are buffered.
+    # The footer is only written by close(), a killed run leaves an unreadable file.
+    def __init__(self, table: DeclarativeMeta, file_path: str='', row_group_size: int=50000, compression: str='zstd'):
+        if pyarrow is None:
+            logger.critical('pyarrow is required by DataBaseType.PARQUET')
+            exit()
+        self.extension = '.parquet'
+        self.table = table
+        self.file_path = file_path
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.columns = [column.name for column in self.table.__table__.columns if not column.primary_key]
+        self.schema = pyarrow.schema([
+            (column.name, get_arrow_type(column.type)) for column in self.table.__table__.columns if not column.primary_key
+        ])
+        self.batches: List['pyarrow.RecordBatch'] = []
+        self.buffered_rows = 0
+        self.file_index = 0
+        self.writer: Optional['pyarrow.parquet.ParquetWriter'] = None
+        self.closed = False
+
+    @property
+    def current_file_path(self) -> str:
+        if self.file_index:
+            return '{}_{}{}'.format(self.file_path, self.file_index, self.extension)
+        return self.file_path + self.extension
+
+    def open(self):
+        # a parquet file can't be appended to, an existing one is never overwritten.
+        while os.path.isfile(self.current_file_path):
+            self.file_index += 1
+        self.writer = pyarrow.parquet.ParquetWriter(self.current_file_path, self.schema, compression=self.compression)
+
+    def save(self, data: List[Record]):
+        if not data:
+            return
+        rows = [record if isinstance(record, tuple) else tuple(record.get(column) for column in self.columns) for record in data]
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        self.batches.append(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.buffered_rows += len(rows)
+        if self.buffered_rows >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if self.writer is None:
+            self.open()
+        if not self.batches:
+            return
+        try:
+            self.writer.write_table(pyarrow.Table.from_batches(self.batches, schema=self.schema), row_group_size=self.buffered_rows)
+        finally:
+            self.batches = []
+            self.buffered_rows = 0
+
+    def close(self):
+        if self.closed:
+            return
+        # opens the writer too, so a run without records still leaves a file with the schema.
         try:
-            with open(self.file_path + self.extension, 'r', newline='') as csv_file:
-                rows = csv.DictReader(csv_file)
-                origin_data = list(rows)
+            self.write_row_group()
+        finally:
+            self.writer.close()
+            self.closed = True
+
+class BackgroundWriter:
+    def __init__(
+            self, 
+            database: Union[DatabaseUtil, JsonUtil, JsonLinesUtil, CsvUtil, ParquetUtil], 
+            batch_size: int=500, 
+            flush_interval: float=5.0, 
+            max_queue_size: int=64,
+            on_saved: Optional[Callable[[List[Any]], None]]=None,
+            on_failed: Optional[Callable[[List[Any], str], None]]=None,
+        ):
+        self.database = database
+        self.batch_size = batch_size
+        # seconds, flush a partial batch once it has waited this long.
+        self.flush_interval = flush_interval
+        # put() blocks once max_queue_size batches are waiting, that's the backpressure to the collector.
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self.collected_data: List[Record] = []
+        # whatever was put along with the data, handed to on_saved once the data is saved.
+        self.on_saved = on_saved
+        # or to on_failed with the error when the storage couldn't save the data, none of it counts as saved then.
+        self.on_failed = on_failed
+        self.collected_done: List[Any] = []
+        self.total_count = 0
+        self.thread = threading.Thread(target=self._run, name='background_writer', daemon=True)
+        self.thread.start()
+
+    def put(self, data: List[Record], done: Optional[List[Any]]=None):
+        if data or done:
+            self.queue.put((data, done or []))
+
+    def flush(self):
+        if not self.collected_data and not self.collected_done:
+            return
+        data, done = self.collected_data, self.collected_done
+        self.collected_data = []
+        self.collected_done = []
+        try:
+            if data:
+                self.database.save(data)
         except Exception as error:
-            pass
-        
-        with open(self.file_path + '_tmp' + self.extension, 'w', newline='') as csv_file:
+            logger.error("Failed to save %s records: %s", len(data), error)
+            self._notify(self.on_failed, done, repr(error))
+            return
+        if data:
+            self.total_count += len(data)
+            logger.info("Saved %s into database", len(data))
+        self._notify(self.on_saved, done)
+
+    def _notify(self, callback: Optional[Callable[..., None]], done: List[Any], *args: Any):
+        if not callback or not done:
+            return
+        try:
+            callback(done, *args)
+        except Exception as error:
+            logger.error(error)
+
+    def _run(self):
+        deadline = time.monotonic() + self.flush_interval
+        while True:
             try:
-                origin_data.extend(data)
-                writer = csv.DictWriter(csv_file, fieldnames=self.field_names)
-                writer.writeheader()
-                writer.writerows(origin_data)
-                os.rename(self.file_path + '_tmp' + self.extension, self.file_path + self.extension)
-            except Exception as error:
-                logger.error(error)
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = ([], [])
+            if item is None:
+                break
+            data, done = item
+            self.collected_data.extend(data)
+            self.collected_done.extend(done)
+            if len(self.collected_data) >= self.batch_size or len(self.collected_done) >= self.batch_size \
+                    or time.monotonic() >= deadline:
+                self.flush()
+                deadline = time.monotonic() + self.flush_interval
+        self.flush()
+
+    def close(self) -> int:
+        # drain everything already queued, then stop.
+        self.queue.put(None)
+        self.thread.join()
+        return self.total_count
 
 def init_database(
         site_name: str,
@@ -102,7 +439,8 @@ def init_database(
         path: str='', 
         file_name: str='',
         fields: Union[DeclarativeMeta, List[str], None]=None,
-    ) -> Union[DatabaseUtil, JsonUtil, CsvUtil]:
+        **options: Any,
+    ) -> Union[DatabaseUtil, JsonUtil, JsonLinesUtil, CsvUtil, ParquetUtil]:
 
     if not path:
         path = os.getcwd() + '/data'
@@ -118,11 +456,17 @@ def init_database(
         pass
 
     if database_type is DataBaseType.DATABASE and fields and not isinstance(fields, list):
-        database = DatabaseUtil(table=fields, file_path=file_path)
+        database = DatabaseUtil(table=fields, file_path=file_path, **options)
     
     elif database_type is DataBaseType.JSON and not fields:
         database = JsonUtil(file_path=file_path)
     
+    elif database_type is DataBaseType.JSONL and not fields:
+        database = JsonLinesUtil(file_path=file_path, **options)
+
     elif database_type is DataBaseType.CSV and fields and isinstance(fields, list):
-        database = CsvUtil(file_path=file_path, field_names=fields)
+        database = CsvUtil(file_path=file_path, field_names=fields, **options)
+
+    elif database_type is DataBaseType.PARQUET and fields and not isinstance(fields, list):
+        database = ParquetUtil(table=fields, file_path=file_path, **options)
     return database
\ No newline at end of file
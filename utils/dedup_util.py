@@ -0,0 +1,117 @@
+import hashlib
+import math
+import os
+import sqlite3
+from typing import List, Optional, Set
+from urllib.parse import urlsplit, urlunsplit
+
+def normalize_url(url: str) -> str:
+    # the same page behind another scheme or host case, or another fragment, is the same url.
+    splitted_url = urlsplit(url.strip())
+    return urlunsplit((splitted_url.scheme.lower(), splitted_url.netloc.lower(), splitted_url.path or '/', splitted_url.query, ''))
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: bytes) -> List[int]:
+        # two hashes make all of them (Kirsch-Mitzenmacher).
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.bit_count for index in range(self.hash_count)]
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def add(self, key: bytes):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+class ScalableBloomFilter:
+    # adds a bigger and stricter filter whenever the last one is full, so the error rate holds
+    # without knowing how many urls a crawl will find.
+    def __init__(self, initial_capacity: int=100000, error_rate: float=0.001, growth: int=2, tightening: float=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening = tightening
+        self.filters: List[BloomFilter] = []
+
+    def __contains__(self, key: bytes) -> bool:
+        return any(key in bloom_filter for bloom_filter in self.filters)
+
+    def add(self, key: bytes):
+        if not self.filters or self.filters[-1].count >= self.filters[-1].capacity:
+            index = len(self.filters)
+            self.filters.append(BloomFilter(
+                self.initial_capacity * self.growth ** index,
+                self.error_rate * (1 - self.tightening) * self.tightening ** index
+            ))
+        self.filters[-1].add(key)
+
+    def __len__(self) -> int:
+        return sum(bloom_filter.count for bloom_filter in self.filters)
+
+class SeenUrls:
+    # the bloom filter answers most lookups from memory, the sqlite file settles its false positives.
+    def __init__(self, file_path: str, initial_capacity: int=100000, error_rate: float=0.001, commit_interval: int=10000):
+        self.file_path = file_path
+        self.bloom_filter = ScalableBloomFilter(initial_capacity, error_rate)
+        self.commit_interval = commit_interval
+        self.uncommitted: Set[bytes] = set()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.file_path, timeout=30)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS seen (key BLOB PRIMARY KEY) WITHOUT ROWID')
+            self._connection.commit()
+            # urls seen by earlier runs.
+            for key, in self._connection.execute('SELECT key FROM seen'):
+                self.bloom_filter.add(key)
+        return self._connection
+
+    def clear(self):
+        self.connection.execute('DELETE FROM seen')
+        self.connection.commit()
+        self.bloom_filter = ScalableBloomFilter(self.bloom_filter.initial_capacity, self.bloom_filter.error_rate)
+
+    def add(self, url: str) -> bool:
+        # True only the first time a url is added.
+        key = hashlib.sha1(normalize_url(url).encode('utf-8')).digest()
+        connection = self.connection
+        if key in self.bloom_filter:
+            if key in self.uncommitted or connection.execute('SELECT 1 FROM seen WHERE key = ?', (key, )).fetchone():
+                return False
+        self.bloom_filter.add(key)
+        self.uncommitted.add(key)
+        if len(self.uncommitted) >= self.commit_interval:
+            self.commit()
+        return True
+
+    def commit(self):
+        if not self.uncommitted:
+            return
+        self.connection.executemany('INSERT OR IGNORE INTO seen (key) VALUES (?)', ((key, ) for key in self.uncommitted))
+        self.connection.commit()
+        self.uncommitted = set()
+
+    def __len__(self) -> int:
+        return len(self.bloom_filter)
+
+    def close(self):
+        if self._connection is None:
+            return
+        self.commit()
+        self._connection.close()
+        self._connection = None
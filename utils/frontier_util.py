@@ -0,0 +1,106 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .helper import param_key
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+class PersistentFrontier:
+    # every param of a run with its status, so an interrupted run can continue where it stopped.
+    def __init__(self, file_path: str, page_size: int=1000, commit_interval: int=100):
+        self.file_path = file_path
+        # new params are committed at least once every page_size of them.
+        self.page_size = page_size
+        # failures are committed with the next saved batch or after this many of them.
+        self.commit_interval = commit_interval
+        self.failures: List[Tuple[str, float, str]] = []
+        # used by the feeder, the collector and the background writer.
+        self.lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.file_path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS frontier ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, param TEXT UNIQUE, status TEXT, attempts INTEGER DEFAULT 0, '
+                'last_error TEXT, updated_at REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS frontier_status ON frontier (status, id)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._connection.commit()
+        return self._connection
+
+    def start(self, file_name: str, resume: bool=False) -> str:
+        # returns the database file name of this run, a resumed run keeps writing into the one it continues.
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'file_name'").fetchone()
+            if resume and row:
+                return row[0]
+            self.connection.execute('DELETE FROM frontier')
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('file_name', ?)", (file_name, ))
+            self.connection.commit()
+        return file_name
+
+    def track(self, params: Iterable[Any], on_skipped: Optional[Callable[[Any], None]]=None) -> Iterator[Any]:
+        # records params as they stream in and passes on the pending ones, params of a resumed run
+        # are already known and keep their status. New rows are committed along with the next marks,
+        # a run that dies before that creates them again when it is resumed.
+        for index, param in enumerate(params):
+            key = param_key(param)
+            with self.lock:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO frontier (param, status, updated_at) VALUES (?, ?, ?)', (key, PENDING, time.time())
+                )
+                status = self.connection.execute('SELECT status FROM frontier WHERE param = ?', (key, )).fetchone()[0]
+                if index % self.page_size == self.page_size - 1:
+                    self.connection.commit()
+            if status == PENDING:
+                yield param
+            elif on_skipped:
+                on_skipped(param)
+
+    def mark_done(self, params: List[Any]):
+        # called once the rows of these params are saved.
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                'UPDATE frontier SET status = ?, attempts = attempts + 1, last_error = NULL, updated_at = ? WHERE param = ?',
+                ((DONE, now, param_key(param)) for param in params)
+            )
+            self._commit_failures()
+
+    def mark_failed(self, param: Any, error: str):
+        with self.lock:
+            self.failures.append((error, time.time(), param_key(param)))
+            if len(self.failures) >= self.commit_interval:
+                self._commit_failures()
+
+    def _commit_failures(self):
+        self.connection.executemany(
+            'UPDATE frontier SET status = ?, attempts = attempts + 1, last_error = ?, updated_at = ? WHERE param = ?',
+            ((FAILED, ) + failure for failure in self.failures)
+        )
+        self.connection.commit()
+        self.failures = []
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute('SELECT status, COUNT(*) FROM frontier GROUP BY status').fetchall())
+
+    def close(self):
+        if self._connection is None:
+            return
+        with self.lock:
+            self._commit_failures()
+            self._connection.close()
+            self._connection = None
@@ -1,5 +1,71 @@
-from typing import List, Any
+import json
+import os
+import random
+import time
+from typing import Any, Callable, Optional, Sequence
 
-def split_chunk(list: List[Any], n=100):
-    for i in range(0, len(list), n):
-        yield list[i: i + n]
\ No newline at end of file
+class WeightedChoice:
+    # Vose's alias method, O(n) to build and O(1) for every choice.
+    def __init__(self, items: Sequence[Any], weights: Optional[Sequence[float]]=None):
+        self.items = list(items)
+        count = len(self.items)
+        if weights is None:
+            weights = [1.0] * count
+        total = float(sum(weights))
+        self.probabilities = [0.0] * count
+        self.aliases = [0] * count
+        if not count or total <= 0:
+            return
+
+        scaled = [weight * count / total for weight in weights]
+        small = [index for index, weight in enumerate(scaled) if weight < 1.0]
+        large = [index for index, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        for index in large + small:
+            self.probabilities[index] = 1.0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def choice(self) -> Any:
+        if not self.items:
+            return None
+        index = random.randrange(len(self.items))
+        if random.random() < self.probabilities[index]:
+            return self.items[index]
+        return self.items[self.aliases[index]]
+
+class JsonFileCache:
+    # loads a json file once per process and builds it again only when its mtime changes.
+    def __init__(self, file_path: str, build: Callable[[Any], Any], check_interval: float=5.0):
+        self.file_path = file_path
+        self.build = build
+        # at most one stat() every check_interval seconds on the hot path.
+        self.check_interval = check_interval
+        self.mtime: Optional[float] = None
+        self.checked_at = 0.0
+        self.value: Any = None
+
+    def get(self) -> Any:
+        now = time.monotonic()
+        if self.mtime is not None and now - self.checked_at < self.check_interval:
+            return self.value
+        self.checked_at = now
+        mtime = os.stat(self.file_path).st_mtime
+        if mtime != self.mtime:
+            with open(self.file_path, 'r', encoding='utf-8') as json_file:
+                self.value = self.build(json.load(json_file))
+            self.mtime = mtime
+        return self.value
+
+def param_key(param: Any) -> str:
+    # the same param always gets the same key, in every store that keeps params.
+    return json.dumps(param, sort_keys=True, ensure_ascii=False, default=str)
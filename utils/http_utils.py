@@ -1,11 +1,19 @@
 import logging
+import json
 import aiohttp
 import asyncio
+import random
+import time
+from collections import deque
 from enum import Enum
+from urllib.parse import urlsplit
 
 from .user_agents import OS, Browser, get_user_agent, UserAgentType
-from .proxies import get_proxy
-from typing import Any, Union, List, Dict, Callable, Optional, Tuple
+from .proxies import ProxyManager
+from .rate_limit_util import SharedRateLimiter
+from .cache_util import ResponseCache, CachedDocument, CacheEntry
+from .archive_util import PageArchive, archive_param
+from typing import Any, Union, List, Dict, Callable, Optional, Tuple, Iterable, Deque
 
 class HTTPMethods(Enum):
     GET = "GET"
@@ -27,6 +35,192 @@ default_headers = {
     "Upgrade-Insecure-Requests": "1"
 }
 
+class HostState:
+    def __init__(self, retry_budget: float) -> None:
+        self.retry_tokens = retry_budget
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+class RetryPolicy:
+    def __init__(
+            self, 
+            retry_times: int=5, 
+            base_delay: float=1.0, 
+            max_delay: float=30.0, 
+            retryable_statuses: Iterable[int]=(403, 408, 425, 429, 500, 502, 503, 504), 
+            fatal_statuses: Iterable[int]=(400, 401, 404, 405, 410, 414, 451), 
+            retry_budget: float=20.0, 
+            retry_budget_ratio: float=0.2, 
+            breaker_threshold: int=10, 
+            breaker_cooldown: float=30.0,
+        ):
+        self.retry_times = retry_times
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # statuses in neither set are retried too, fatal ones are never retried.
+        self.retryable_statuses = frozenset(retryable_statuses)
+        self.fatal_statuses = frozenset(fatal_statuses)
+        # every request to a host earns retry_budget_ratio retries, up to retry_budget.
+        self.retry_budget = retry_budget
+        self.retry_budget_ratio = retry_budget_ratio
+        # consecutive failures of a host before its requests wait breaker_cooldown seconds.
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.hosts: Dict[str, HostState] = {}
+
+    def host_state(self, host: str) -> HostState:
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.retry_budget)
+        return state
+
+    def is_fatal(self, status_code: int) -> bool:
+        return status_code in self.fatal_statuses
+
+    def backoff(self, attempt: int) -> float:
+        # full jitter, so retries of many coroutines don't hit the host at the same moment.
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def on_request(self, host: str):
+        state = self.host_state(host)
+        state.retry_tokens = min(state.retry_tokens + self.retry_budget_ratio, self.retry_budget)
+
+    def acquire_retry(self, host: str) -> bool:
+        state = self.host_state(host)
+        if state.retry_tokens < 1:
+            return False
+        state.retry_tokens -= 1
+        return True
+
+    async def wait(self, host: str):
+        # an open breaker holds every request of the host, then lets one probe through.
+        state = self.host_state(host)
+        while state.open_until:
+            now = time.monotonic()
+            if now < state.open_until:
+                await asyncio.sleep(state.open_until - now)
+            elif not state.probing:
+                state.probing = True
+                return
+            else:
+                await asyncio.sleep(min(self.breaker_cooldown, 1.0))
+
+    def record_success(self, host: str):
+        state = self.host_state(host)
+        state.consecutive_failures = 0
+        state.open_until = 0.0
+        state.probing = False
+
+    def record_failure(self, host: str) -> bool:
+        state = self.host_state(host)
+        state.consecutive_failures += 1
+        state.probing = False
+        if state.consecutive_failures >= self.breaker_threshold:
+            opened = not state.open_until
+            state.open_until = time.monotonic() + self.breaker_cooldown
+            return opened
+        return False
+
+class ConcurrencyController:
+    # AIMD limit of in-flight requests of one process, every pool process gets its own copy.
+    def __init__(
+            self, 
+            initial_limit: int=5, 
+            min_limit: int=1, 
+            max_limit: int=100, 
+            min_window: int=20, 
+            increase_step: float=1.0, 
+            decrease_factor: float=0.5, 
+            max_error_rate: float=0.05, 
+            latency_tolerance: float=3.0, 
+            min_latency: float=0.5,
+        ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        # adjust about once per round trip of the whole window of in-flight requests.
+        self.min_window = min_window
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.max_error_rate = max_error_rate
+        # p95 latency over latency_tolerance times the baseline median means the site is queueing us.
+        self.latency_tolerance = latency_tolerance
+        # p95 latency under min_latency seconds is never treated as congestion.
+        self.min_latency = min_latency
+        self.baseline_latency: Optional[float] = None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.samples: List[Tuple[float, bool, bool]] = []
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self.wake()
+                raise
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def wake(self):
+        free_slots = int(self.limit) - self.in_flight
+        while free_slots > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free_slots -= 1
+
+    def release(self, latency: float, congested: bool, timed_out: bool) -> Optional[str]:
+        # returns a log message when the limit changed.
+        self.in_flight -= 1
+        self.samples.append((latency, congested, timed_out))
+        message = None
+        if len(self.samples) >= max(self.min_window, int(self.limit)):
+            message = self.adjust()
+        self.wake()
+        return message
+
+    def adjust(self) -> Optional[str]:
+        samples = self.samples
+        self.samples = []
+        peak_in_flight = self.peak_in_flight
+        self.peak_in_flight = self.in_flight
+
+        latencies = sorted([latency for latency, _, _ in samples])
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        error_rate = sum(1 for _, congested, _ in samples if congested) / len(samples)
+        timeouts = sum(1 for _, _, timed_out in samples if timed_out)
+        # the baseline follows the lowest median but can drift up slowly when the site gets slower for good.
+        if self.baseline_latency is None:
+            self.baseline_latency = p50
+        else:
+            self.baseline_latency = min(p50, self.baseline_latency * 1.1)
+
+        reason = None
+        if timeouts:
+            reason = '{} timeouts'.format(timeouts)
+        elif error_rate > self.max_error_rate:
+            reason = 'error rate {:.1%}'.format(error_rate)
+        elif p95 > max(self.baseline_latency * self.latency_tolerance, self.min_latency):
+            reason = 'p95 latency {:.2f}s over baseline {:.2f}s'.format(p95, self.baseline_latency)
+
+        old_limit = int(self.limit)
+        if reason:
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        elif peak_in_flight >= old_limit:
+            # only grow when the limit is what actually holds requests back.
+            self.limit = min(float(self.max_limit), self.limit + self.increase_step)
+            reason = 'healthy, p50 {:.2f}s p95 {:.2f}s error rate {:.1%}'.format(p50, p95, error_rate)
+
+        if int(self.limit) == old_limit:
+            return None
+        return 'Concurrency limit {} -> {}: {}'.format(old_limit, int(self.limit), reason)
+
 class AsyncRequestUtil:
     
     def __init__(
@@ -42,6 +236,13 @@ class AsyncRequestUtil:
             timeout: int=30, 
             proxy_countries: List[str]=None, 
             user_agent_type: UserAgentType=UserAgentType(OS.MACOS, Browser.CHROME),
+            retry_policy: Optional[RetryPolicy]=None,
+            rate_limiter: Optional[SharedRateLimiter]=None,
+            concurrency_controller: Optional[ConcurrencyController]=None,
+            rotate_identity: bool=False,
+            proxy_manager: Optional[ProxyManager]=None,
+            response_cache: Optional[ResponseCache]=None,
+            page_archive: Optional[PageArchive]=None,
         ):
         
         self.loop = loop
@@ -51,8 +252,16 @@ class AsyncRequestUtil:
         self.retry_times = retry_times
         self.timeout = timeout
         self.sleep_seconds = sleep_seconds
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy(retry_times=retry_times, max_delay=sleep_seconds)
+        self.rate_limiter = rate_limiter
+        self.concurrency_controller = concurrency_controller
+        # pick a user agent and a proxy for every request instead of once per session.
+        self.rotate_identity = rotate_identity
+        self.response_cache = response_cache
+        # keeps the body of every successful response, so its page can be parsed again offline.
+        self.page_archive = page_archive
         self.user_agent_type = user_agent_type
-        self.headers = default_headers if default_headers_enable else {}
+        self.headers = dict(default_headers) if default_headers_enable else {}
         self.headers['user-agent'] = get_user_agent(user_agent_type)
         
         if isinstance(headers, str):
@@ -61,12 +270,16 @@ class AsyncRequestUtil:
 
         if isinstance(cookies, str):
             cookies = self.__class__.__get_cookies_dict_from_string(cookies)
-        self.cookies = cookies
+        self.cookies = dict(cookies)
+        # cookies set by main_page_url, requested on the first request and again when a request is retried.
+        self.main_page_cookies: Dict[str, str] = {}
+        self.cookie_task: Optional[asyncio.Future] = None
 
-        self.proxy = None
         self.proxy_countries = proxy_countries
-        if proxy_countries:
-            self.proxy = get_proxy(proxy_countries)
+        # picks a healthy proxy for every attempt.
+        self.proxy_manager = proxy_manager
+        if proxy_countries and not proxy_manager:
+            self.proxy_manager = ProxyManager(proxy_countries)
 
     @classmethod
     def __get_cookies_dict_from_string(cls, cookies_string: str) -> Dict[str, str]:
@@ -85,23 +298,31 @@ class AsyncRequestUtil:
                 headers[splitted_header[0]] = splitted_header[1]
         return headers
 
-    async def reset(self):
-        await asyncio.sleep(self.sleep_seconds)
-        self.headers['user-agent'] = get_user_agent(self.user_agent_type)
-        if self.proxy_countries:
-            self.proxy = get_proxy(self.proxy_countries)
-        await self.init_cookie()
-
     async def close(self):
+        if self.proxy_manager:
+            self.proxy_manager.save()
+        if self.response_cache:
+            self.response_cache.close()
+        if self.page_archive:
+            self.page_archive.close()
         await self.session.close()
-        self.loop.close()
+        if not self.loop.is_running():
+            self.loop.close()
 
-    async def init_cookie(self):
-        if self.main_page_url:
-            response = await self.session.get(self.main_page_url, ssl=False)
-            cookies = response.cookies
-            cookies.update(self.cookies)
-            self.cookies = cookies
+    async def init_cookie(self, refresh: bool=False):
+        # concurrent requests share one request of the main page.
+        if not self.main_page_url:
+            return
+        if self.cookie_task is None or (refresh and self.cookie_task.done()):
+            self.cookie_task = asyncio.ensure_future(self.__request_cookies())
+        await asyncio.shield(self.cookie_task)
+
+    async def __request_cookies(self):
+        try:
+            async with self.session.get(self.main_page_url, headers=self.headers, timeout=self.timeout, ssl=False) as response:
+                self.main_page_cookies = {key: morsel.value for key, morsel in response.cookies.items()}
+        except Exception as error:
+            self.logger.warning('Cookies of %s failed %s', self.main_page_url, error)
 
     async def get(
             self, 
@@ -170,6 +391,27 @@ class AsyncRequestUtil:
             self.logger.warning('Retry %s', kwargs['url'])
         return result
 
+    def __get_cached(self, cache_key: str) -> Optional[CacheEntry]:
+        try:
+            return self.response_cache.get(cache_key)
+        except Exception as error:
+            self.logger.warning('Cache read failed %s', error)
+            return None
+
+    def __put_cached(self, cache_key: str, url: str, status_code: int, body: bytes, response_headers: Any):
+        try:
+            self.response_cache.put(
+                cache_key, url, status_code, body, response_headers.get('ETag'), response_headers.get('Last-Modified')
+            )
+        except Exception as error:
+            self.logger.warning('Cache write failed %s', error)
+
+    def __archive(self, url: str, status_code: int, body: bytes, etag: Optional[str], last_modified: Optional[str], content_type: Optional[str]=None):
+        try:
+            self.page_archive.append(url, status_code, body, archive_param.get(), etag, last_modified, content_type)
+        except Exception as error:
+            self.logger.warning('Archive write failed %s', error)
+
     async def __request(
             self, 
             method, 
@@ -186,45 +428,109 @@ class AsyncRequestUtil:
             with_return: Any=None
         ) -> Union[Union[None, Dict[str, Any], bytes], Tuple[Union[None, Dict[str, Any], bytes], Any]]:
 
+        # every request works on its own copy, retries rotate the identity of this request only.
+        request_headers = dict(self.headers)
         if referer:
-            self.headers['referer'] = referer
+            request_headers['referer'] = referer
         
         if headers:
             if isinstance(headers, str):
                 headers = self.__class__.__get_headers_dict_from_string(headers)
-            self.headers.update(headers)
+            request_headers.update(headers)
 
+        request_cookies = dict(self.cookies)
         if cookies:
             if isinstance(cookies, str):
                 cookies = self.__class__.__get_cookies_dict_from_string(cookies)
-            self.cookies.update(cookies)
+            request_cookies.update(cookies)
 
+        if self.rotate_identity:
+            request_headers['user-agent'] = get_user_agent(self.user_agent_type)
+        splitted_url = urlsplit(url)
+        host = splitted_url.hostname or ''
+
+        # unchanged pages come back as CachedDocument, fresh ones without any request.
+        cache_key = None
+        cache_entry = None
+        if self.response_cache:
+            cache_key = ResponseCache.get_key(method.__name__.upper(), url, query_strings, body, json_body)
+            cache_entry = self.__get_cached(cache_key)
+            if cache_entry and self.response_cache.is_fresh(cache_entry):
+                if self.page_archive:
+                    self.__archive(url, cache_entry.status, cache_entry.body, cache_entry.etag, cache_entry.last_modified)
+                document = CachedDocument(cache_entry.body)
+                response = json.loads(document) if json_response else document
+                return (response, with_return) if with_return else response
+            if cache_entry and cache_entry.etag:
+                request_headers['If-None-Match'] = cache_entry.etag
+            if cache_entry and cache_entry.last_modified:
+                request_headers['If-Modified-Since'] = cache_entry.last_modified
+
+        retry_policy = self.retry_policy
+        retry_policy.on_request(host)
         retry_function = retry_function if retry_function else self.__retry_function
-        for _ in range(self.retry_times):
+        succeeded = False
+        for attempt in range(retry_policy.retry_times):
+            if attempt:
+                if not retry_policy.acquire_retry(host):
+                    self.logger.warning('Retry budget of %s exhausted', host)
+                    break
+                await asyncio.sleep(retry_policy.backoff(attempt))
+                request_headers['user-agent'] = get_user_agent(self.user_agent_type)
+            await retry_policy.wait(host)
+            if self.main_page_url:
+                await self.init_cookie(refresh=bool(attempt))
+                # cookies given by the caller win over the ones of the main page.
+                request_cookies = {**self.main_page_cookies, **self.cookies, **(cookies or {})}
+
+            status_code = 0
+            congested = True
+            timed_out = False
+            transport_error = False
+            if self.concurrency_controller:
+                await self.concurrency_controller.acquire()
+            proxy = None
+            if self.proxy_manager:
+                proxy = await self.proxy_manager.acquire(splitted_url.scheme)
+            if self.rate_limiter:
+                await self.rate_limiter.acquire(host)
+            started = time.monotonic()
             try:
                 response = await method(
                     url=url,
                     params=query_strings,
-                    headers=self.headers,
+                    headers=request_headers,
                     json=json_body,
                     data=body,
-                    cookies=self.cookies,
+                    cookies=request_cookies,
                     timeout=self.timeout,
                     allow_redirects=allow_redirects,
-                    proxy=self.proxy,
+                    proxy=proxy,
                     ssl=False
                 )
                 
-                status_code = 0
+                status_code = response.status
+                congested = status_code in retry_policy.retryable_statuses
+                response_headers = response.headers
+                if status_code == 304 and cache_entry:
+                    response.release()
+                    self.response_cache.touch(cache_key)
+                    if self.page_archive:
+                        self.__archive(url, cache_entry.status, cache_entry.body, cache_entry.etag, cache_entry.last_modified)
+                    document = CachedDocument(cache_entry.body)
+                    response = json.loads(document) if json_response else document
+                    succeeded = True
+                    retry_policy.record_success(host)
+                    break
 
-                if json_response:   
-                    status_code = response.status
+                raw_body = None
+                if json_response and not cache_key and not self.page_archive:
                     response = await response.json()
                 else:
-                    status_code = response.status
-                    response = await response.read()
+                    raw_body = await response.read()
+                    response = json.loads(raw_body) if json_response else raw_body
                 
-                if not retry_function(
+                if retry_function(
                             status_code=status_code, 
                             response=response, 
                             url=url, 
@@ -234,11 +540,40 @@ class AsyncRequestUtil:
                             headers=headers, 
                             cookies=cookies
                         ):
-                        raise
-                break
+                    succeeded = True
+                    retry_policy.record_success(host)
+                    if cache_key and status_code == 200:
+                        self.__put_cached(cache_key, url, status_code, raw_body, response_headers)
+                    if self.page_archive and raw_body:
+                        self.__archive(
+                            url, status_code, raw_body, response_headers.get('ETag'), 
+                            response_headers.get('Last-Modified'), response_headers.get('Content-Type')
+                        )
+                    break
             except Exception as error:
-                await self.reset()
-        else:
+                timed_out = isinstance(error, asyncio.TimeoutError)
+                transport_error = timed_out or isinstance(
+                    error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, aiohttp.ClientHttpProxyError)
+                )
+            finally:
+                if self.rate_limiter:
+                    self.rate_limiter.release(host)
+                if proxy:
+                    self.proxy_manager.release(proxy, time.monotonic() - started, status_code, transport_error)
+                if self.concurrency_controller:
+                    message = self.concurrency_controller.release(time.monotonic() - started, congested, timed_out)
+                    if message:
+                        self.logger.info(message)
+
+            if retry_policy.is_fatal(status_code):
+                # the host did answer, so a probe of an open breaker ends here too.
+                retry_policy.record_success(host)
+                self.logger.warning('Fatal status %s of %s', status_code, url)
+                break
+            if retry_policy.record_failure(host):
+                self.logger.warning('Circuit of %s opened for %ss', host, retry_policy.breaker_cooldown)
+
+        if not succeeded:
             self.logger.warning('Retry and Fail of %s', url)
             response = None
         if with_return:
@@ -79,6 +79,8 @@ class MultiProcesses_Logger_Util:
             logger = logging.getLogger(record.name)
             logger.handle(record)
 
-    def close(self):
-        self.process.join(timeout=0)
+    def close(self, timeout: float=5.0):
+        # let the logging process write what is still queued, e.g. the final stats of a run.
+        self.queue.put_nowait(None)
+        self.process.join(timeout=timeout)
         self.process.terminate()
@@ -0,0 +1,94 @@
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from .helper import param_key
+
+class Listing:
+    def __init__(self, listing: Any, total_pages: Optional[int]):
+        self.listing = listing
+        # only a hint, the listing ends at its first empty or short page.
+        self.total_pages = total_pages
+        self.next_page = 1
+        self.in_flight = 0
+        self.counts: Dict[int, Optional[int]] = {}
+        self.end_page: Optional[int] = None
+
+class Paginator:
+    # Paginator(lambda category, page: {'url': ..., 'page': page}, window=2)
+    # keeps up to window pages of every listing in flight, and stops a listing at its first empty or short page.
+    def __init__(self, make_param: Callable[[Any, int], Any], window: int=2, page_size: Optional[int]=None):
+        self.make_param = make_param
+        self.window = window
+        # items of a full page, only learned from the largest page of each listing for sites where it is unknown.
+        self.page_size = page_size
+        self.in_flight: Dict[str, Tuple[Listing, int]] = {}
+        self.ready: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.listings_done = False
+        self.finished = False
+        self.requested_count = 0
+
+    def paginate(self, listings: Iterable[Tuple[Any, Optional[int]]]) -> Iterator[Any]:
+        # listings are (listing, total_pages hint) pairs. Yields the first pages of each listing as it comes in,
+        # and the next pages as the parsed ones are reported to on_page.
+        threading.Thread(target=self._start, args=(listings, ), name='paginator', daemon=True).start()
+        while True:
+            param = self.ready.get()
+            if param is None:
+                return
+            yield param
+
+    def _start(self, listings: Iterable[Tuple[Any, Optional[int]]]):
+        try:
+            for listing, total_pages in listings:
+                with self.lock:
+                    self._schedule(Listing(listing, total_pages))
+        finally:
+            with self.lock:
+                self.listings_done = True
+                self._finish_if_done()
+
+    def _can_schedule(self, listing: Listing) -> bool:
+        if listing.end_page is not None or listing.in_flight >= self.window:
+            return False
+        page = listing.next_page
+        if page == 1 or listing.total_pages is None or page <= listing.total_pages:
+            return True
+        # past the hint, one page at a time and only after a full one.
+        return listing.counts.get(page - 1) is not None
+
+    def _schedule(self, listing: Listing):
+        while self._can_schedule(listing):
+            param = self.make_param(listing.listing, listing.next_page)
+            self.in_flight[param_key(param)] = (listing, listing.next_page)
+            listing.next_page += 1
+            listing.in_flight += 1
+            self.requested_count += 1
+            self.ready.put(param)
+
+    def on_page(self, param: Any, count: Optional[int]):
+        # count is the number of items parsed from the page, None when it was not fetched or parsed.
+        with self.lock:
+            page_info = self.in_flight.pop(param_key(param), None)
+            if page_info is None:
+                return
+            listing, page = page_info
+            listing.in_flight -= 1
+            listing.counts[page] = count
+            page_size = self.page_size or max((value for value in listing.counts.values() if value), default=0)
+            for known_page, known_count in listing.counts.items():
+                if known_count is None:
+                    # nothing to tell, so it ends the listing unless the hint says there is more.
+                    is_end = listing.total_pages is None or known_page >= listing.total_pages
+                else:
+                    is_end = known_count == 0 or known_count < page_size
+                if is_end and (listing.end_page is None or known_page < listing.end_page):
+                    listing.end_page = known_page
+            self._schedule(listing)
+            self._finish_if_done()
+
+    def _finish_if_done(self):
+        if self.listings_done and not self.in_flight and not self.finished:
+            self.finished = True
+            self.ready.put(None)
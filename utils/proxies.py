@@ -1,22 +1,207 @@
-import random
+import asyncio
 import json
+import os
+import random
+import time
 from enum import Enum
-from typing import List, Dict
+from typing import Any, List, Dict, Optional
+
+from .helper import JsonFileCache, WeightedChoice
 
 class Countries(Enum):
     # TODO: add countries
     TW = 'tw'
 
+proxies_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxies.json')
+proxy_scores_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy_scores.json')
+
+def build_proxies(data: Dict[str, Any]) -> Dict[str, WeightedChoice]:
+    # an entry is {"http": "...", "https": "..."} with an optional "weight".
+    proxies = {}
+    for country, entries in data.items():
+        if not isinstance(entries, list):
+            continue
+        values = [{key: value for key, value in entry.items() if key != 'weight'} for entry in entries]
+        weights = [entry.get('weight', 1.0) for entry in entries]
+        proxies[country] = WeightedChoice(values, weights)
+    return proxies
+
+class ProxyPool:
+    def __init__(self, file_path: str=proxies_file_path, check_interval: float=5.0):
+        self.cache = JsonFileCache(file_path, build_proxies, check_interval)
+
+    def get(self, country_list: List[str]) -> Optional[Dict[str, str]]:
+        proxy = None
+        try:
+            proxies = self.cache.get()
+            country = random.choice(country_list)
+            proxy = proxies[country].choice()
+        except Exception as error:
+            pass
+        return proxy
+
+proxy_pool = ProxyPool()
+
 def get_proxy(country_list: List[str]) -> Dict[str, str]:
-    data = None
-    proxy = None
-    try:
-        with open('proxies.json', 'r') as json_file:
-            data = json.load(json_file)
-        country = random.choice(country_list)
-        proxies = data[country]
-        proxy = random.choice(proxies)
-    except Exception as error:
-        pass
-    
-    return proxy
\ No newline at end of file
+    return proxy_pool.get(country_list)
+
+
+class ProxyStats:
+    def __init__(
+            self, 
+            success_rate: float=1.0, 
+            latency: Optional[float]=None, 
+            quarantine_level: int=0, 
+            quarantine_until: float=0.0, 
+            updated_at: float=0.0,
+        ):
+        # unknown proxies start optimistic, so every proxy gets tried.
+        self.success_rate = success_rate
+        self.latency = latency
+        self.quarantine_level = quarantine_level
+        self.updated_at = updated_at
+        # wall clock, so a quarantine outlives the run.
+        self.quarantine_until = quarantine_until
+        self.consecutive_failures = 0
+        self.in_flight = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'success_rate': self.success_rate, 
+            'latency': self.latency, 
+            'quarantine_level': self.quarantine_level, 
+            'quarantine_until': self.quarantine_until, 
+            'updated_at': self.updated_at
+        }
+
+class ProxyManager:
+    # scores every proxy of one process, ProxyManager(['tw']).
+    def __init__(
+            self, 
+            country_list: List[str], 
+            pool: ProxyPool=proxy_pool, 
+            max_in_flight_per_proxy: int=4, 
+            ewma_alpha: float=0.2, 
+            max_failures: int=3, 
+            base_cooldown: float=30.0, 
+            max_cooldown: float=1800.0, 
+            ban_statuses: List[int]=[403, 407, 429], 
+            poll_seconds: float=0.5, 
+            scores_file_path: Optional[str]=proxy_scores_file_path,
+        ):
+        self.country_list = country_list
+        self.pool = pool
+        self.max_in_flight_per_proxy = max_in_flight_per_proxy
+        self.ewma_alpha = ewma_alpha
+        self.max_failures = max_failures
+        # a quarantined proxy rests base_cooldown * 2 ** level seconds, up to max_cooldown.
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.ban_statuses = set(ban_statuses)
+        self.poll_seconds = poll_seconds
+        self.scores_file_path = scores_file_path
+        self.stats: Dict[str, ProxyStats] = {}
+        self.load()
+
+    def proxies(self, scheme: str) -> List[str]:
+        # proxies.json maps every scheme to its own proxy url.
+        proxies = self.pool.cache.get()
+        urls = []
+        for country in self.country_list:
+            if country not in proxies:
+                continue
+            for entry in proxies[country].items:
+                url = entry.get(scheme) or entry.get('http')
+                if url:
+                    urls.append(url)
+        return urls
+
+    def get_stats(self, proxy: str) -> ProxyStats:
+        stats = self.stats.get(proxy)
+        if stats is None:
+            stats = self.stats[proxy] = ProxyStats()
+        return stats
+
+    def score(self, stats: ProxyStats) -> float:
+        latency = stats.latency if stats.latency is not None else 1.0
+        return stats.success_rate ** 2 / (latency + 0.1)
+
+    def try_acquire(self, scheme: str) -> Optional[str]:
+        now = time.time()
+        candidates = []
+        weights = []
+        for proxy in self.proxies(scheme):
+            stats = self.get_stats(proxy)
+            if stats.quarantine_until > now or stats.in_flight >= self.max_in_flight_per_proxy:
+                continue
+            candidates.append(proxy)
+            weights.append(self.score(stats) + 1e-6)
+        if not candidates:
+            return None
+        proxy = random.choices(candidates, weights)[0]
+        self.get_stats(proxy).in_flight += 1
+        return proxy
+
+    async def acquire(self, scheme: str) -> Optional[str]:
+        # waits while every proxy is busy or quarantined, returns None when there is no proxy at all.
+        while True:
+            proxy = self.try_acquire(scheme)
+            if proxy or not self.proxies(scheme):
+                return proxy
+            await asyncio.sleep(self.poll_seconds)
+
+    def release(self, proxy: str, latency: float, status_code: int=0, transport_error: bool=False):
+        # only transport errors, timeouts and ban statuses count against a proxy, any other response
+        # means it delivered the request. Neither of them, like a body that failed to decode, is neutral.
+        stats = self.get_stats(proxy)
+        stats.in_flight -= 1
+        failed = transport_error or status_code in self.ban_statuses
+        if not failed and not status_code:
+            return
+        stats.updated_at = time.time()
+        alpha = self.ewma_alpha
+        stats.success_rate = (1 - alpha) * stats.success_rate + alpha * (0.0 if failed else 1.0)
+        if not failed:
+            stats.latency = latency if stats.latency is None else (1 - alpha) * stats.latency + alpha * latency
+            stats.consecutive_failures = 0
+            stats.quarantine_level = 0
+            return
+
+        stats.consecutive_failures += 1
+        if status_code in self.ban_statuses or stats.consecutive_failures >= self.max_failures:
+            cooldown = min(self.base_cooldown * 2 ** stats.quarantine_level, self.max_cooldown)
+            stats.quarantine_until = time.time() + cooldown
+            stats.quarantine_level += 1
+            stats.consecutive_failures = 0
+
+    def load(self):
+        if not self.scores_file_path or not os.path.isfile(self.scores_file_path):
+            return
+        try:
+            with open(self.scores_file_path, 'r', encoding='utf-8') as json_file:
+                scores = json.load(json_file)
+            for proxy, score in scores.items():
+                self.stats[proxy] = ProxyStats(**score)
+        except Exception as error:
+            pass
+
+    def save(self):
+        # several processes save the same file, the latest update of every proxy wins.
+        if not self.scores_file_path:
+            return
+        scores = {}
+        try:
+            with open(self.scores_file_path, 'r', encoding='utf-8') as json_file:
+                scores = json.load(json_file)
+        except Exception as error:
+            pass
+        for proxy, stats in self.stats.items():
+            if stats.updated_at >= scores.get(proxy, {}).get('updated_at', 0.0):
+                scores[proxy] = stats.to_dict()
+        tmp_file_path = '{}_{}_tmp'.format(self.scores_file_path, os.getpid())
+        try:
+            with open(tmp_file_path, 'w', encoding='utf-8') as json_file:
+                json.dump(scores, json_file)
+            os.replace(tmp_file_path, self.scores_file_path)
+        except Exception as error:
+            pass
@@ -0,0 +1,72 @@
+import asyncio
+import multiprocessing
+import time
+from typing import Dict, List, Tuple
+
+GLOBAL = '*'
+
+class SharedRateLimiter:
+    # created in the main process before the pools fork, every process shares the same buckets.
+    # SharedRateLimiter({'movies.yahoo.com.tw': (10, 50), GLOBAL: (0, 200)}), 0 means unlimited.
+    def __init__(self, limits: Dict[str, Tuple[float, int]], burst_seconds: float=1.0, poll_seconds: float=0.05):
+        self.hosts = list(limits)
+        self.index = {host: index for index, host in enumerate(self.hosts)}
+        self.poll_seconds = poll_seconds
+
+        rates = [float(limits[host][0]) for host in self.hosts]
+        now = time.monotonic()
+        self.rates = multiprocessing.RawArray('d', rates)
+        self.concurrency = multiprocessing.RawArray('i', [int(limits[host][1]) for host in self.hosts])
+        # a bucket holds at most burst_seconds worth of requests.
+        self.burst = multiprocessing.RawArray('d', [max(rate * burst_seconds, 1.0) for rate in rates])
+        self.tokens = multiprocessing.RawArray('d', list(self.burst))
+        self.updated = multiprocessing.RawArray('d', [now] * len(self.hosts))
+        self.in_flight = multiprocessing.RawArray('i', [0] * len(self.hosts))
+        self.locks = [multiprocessing.Lock() for _ in self.hosts]
+
+    def keys(self, host: str) -> List[int]:
+        # always take the global slot before the host slot, so two requests never wait on each other.
+        return [self.index[key] for key in (GLOBAL, host) if key in self.index]
+
+    def try_acquire(self, index: int) -> float:
+        # returns 0 once a slot is taken, else the seconds to wait before trying again.
+        with self.locks[index]:
+            concurrency = self.concurrency[index]
+            if concurrency and self.in_flight[index] >= concurrency:
+                return self.poll_seconds
+
+            rate = self.rates[index]
+            if rate:
+                now = time.monotonic()
+                tokens = min(self.burst[index], self.tokens[index] + (now - self.updated[index]) * rate)
+                self.updated[index] = now
+                if tokens < 1:
+                    self.tokens[index] = tokens
+                    return (1 - tokens) / rate
+                self.tokens[index] = tokens - 1
+
+            self.in_flight[index] += 1
+            return 0.0
+
+    async def acquire(self, host: str):
+        acquired = []
+        try:
+            for index in self.keys(host):
+                while True:
+                    wait_seconds = self.try_acquire(index)
+                    if not wait_seconds:
+                        break
+                    await asyncio.sleep(wait_seconds)
+                acquired.append(index)
+        except BaseException:
+            for index in acquired:
+                self.release_slot(index)
+            raise
+
+    def release(self, host: str):
+        for index in self.keys(host):
+            self.release_slot(index)
+
+    def release_slot(self, index: int):
+        with self.locks[index]:
+            self.in_flight[index] -= 1
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+from typing import Any, Iterable, Iterator, Optional, Set
+
+from .helper import param_key
+
+logger = logging.getLogger('retry_log')
+
+class RetryLog:
+    # one json line per failed param, a param is only written once however often it fails.
+    def __init__(self, file_path: str='retry_info.jsonl'):
+        self.file_path = file_path
+        self._keys: Optional[Set[str]] = None
+        # params that failed while this log was open, compaction never drops them.
+        self.failed_keys: Set[str] = set()
+
+    @property
+    def keys(self) -> Set[str]:
+        if self._keys is None:
+            self._keys = set()
+            if os.path.isfile(self.file_path):
+                with open(self.file_path, 'r', encoding='utf-8') as retry_file:
+                    self._keys = {line.rstrip('\n') for line in retry_file if line.strip()}
+        return self._keys
+
+    def append(self, params: Iterable[Any]):
+        lines = []
+        for param in params:
+            key = param_key(param)
+            self.failed_keys.add(key)
+            if key not in self.keys:
+                self.keys.add(key)
+                lines.append(key + '\n')
+        if not lines:
+            return
+        with open(self.file_path, 'a', encoding='utf-8') as retry_file:
+            retry_file.write(''.join(lines))
+
+    def __iter__(self) -> Iterator[Any]:
+        if not os.path.isfile(self.file_path):
+            return
+        seen = set()
+        with open(self.file_path, 'r', encoding='utf-8') as retry_file:
+            for line in retry_file:
+                key = line.rstrip('\n')
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+                yield json.loads(key)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def compact(self, succeeded: Iterable[Any]) -> int:
+        # drops the params that succeeded and didn't fail again, returns how many are left.
+        removed_keys = {param_key(param) for param in succeeded} - self.failed_keys
+        if not removed_keys or not os.path.isfile(self.file_path):
+            return len(self)
+        keys = [key for key in map(param_key, self) if key not in removed_keys]
+        tmp_file_path = self.file_path + '.tmp'
+        try:
+            with open(tmp_file_path, 'w', encoding='utf-8') as retry_file:
+                retry_file.write(''.join(key + '\n' for key in keys))
+            os.replace(tmp_file_path, self.file_path)
+            self._keys = set(keys)
+        except Exception as error:
+            logger.error(error)
+        return len(self)
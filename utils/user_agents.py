@@ -1,7 +1,9 @@
-import random
+import os
 from enum import Enum
-import json
 from collections import namedtuple
+from typing import Any, Dict
+
+from .helper import JsonFileCache, WeightedChoice
 
 class OS(Enum):
     # TODO: add os
@@ -14,12 +16,34 @@ class Browser(Enum):
 
 UserAgentType = namedtuple('UserAgentType', ['os', 'browser'])
 
+default_user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
+user_agents_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_agents.json')
+
+def build_user_agents(data: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, WeightedChoice]]:
+    # an entry is either a user agent or {"user_agent": "...", "weight": 2}.
+    user_agents = {}
+    for os_name, browsers in data.items():
+        user_agents[os_name] = {}
+        for browser_name, entries in browsers.items():
+            values = [entry['user_agent'] if isinstance(entry, dict) else entry for entry in entries]
+            weights = [entry.get('weight', 1.0) if isinstance(entry, dict) else 1.0 for entry in entries]
+            user_agents[os_name][browser_name] = WeightedChoice(values, weights)
+    return user_agents
+
+class UserAgentPool:
+    def __init__(self, file_path: str=user_agents_file_path, check_interval: float=5.0):
+        self.cache = JsonFileCache(file_path, build_user_agents, check_interval)
+
+    def get(self, user_agent_type: UserAgentType) -> str:
+        user_agent = None
+        try:
+            user_agents = self.cache.get()
+            user_agent = user_agents[user_agent_type.os.value][user_agent_type.browser.value].choice()
+        except Exception as error:
+            pass
+        return user_agent if user_agent else default_user_agent
+
+user_agent_pool = UserAgentPool()
+
 def get_user_agent(user_agent_type: UserAgentType) -> str:
-    user_agent = ""
-    try:
-        with open('user_agents.json', 'r') as json_file:
-            user_agents = json.load(json_file)
-        user_agent = random.choice(user_agents[user_agent_type.os.value][user_agent_type.browser.value])
-    except:
-        user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
-    return user_agent
\ No newline at end of file
+    return user_agent_pool.get(user_agent_type)